@@ -9,10 +9,60 @@
 
 # TODO: Replace OptionParser with ArgParse
 #
-from optparse import OptionParser
+# Modules only some modes need (optparse, json, multiprocessing, numpy...)
+# are imported where they're used, so that they don't slow down the start
+# of every run.
 import sys
+import os
+import copy
 import re
-import random
+import time
+import io
+from array import array
+from collections import OrderedDict, deque
+from operator import attrgetter, itemgetter
+
+def load_numpy():
+    """ Returns the numpy module, or None if it isn't installed.  It's
+    imported on first use: only --numpy needs it, and it's slow to import.
+    """
+    global numpy
+    if 'numpy' not in globals():
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+    return numpy
+
+def __getattr__(name):
+    """ Module attributes made on first use: numpy, and the server classes
+    (see server_classes).
+    """
+    if name == 'numpy':
+        return load_numpy()
+    if name in ('AssemblerRequestHandler', 'AssemblerServer'):
+        server_classes()
+        return globals()[name]
+    raise AttributeError("module " + repr(__name__) + " has no attribute " +
+                         repr(name))
+
+class lazy_regex:
+    """ Descriptor for a regular expression class attribute, compiled the
+    first time it's used, rather than on every start.  Then the compiled
+    pattern replaces the descriptor on the class.
+    """
+
+    def __init__(self, pattern, flags=0):
+        self.pattern = pattern
+        self.flags = flags
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        regex = re.compile(self.pattern, self.flags)
+        setattr(owner, self.name, regex)
+        return regex
 
 class ParseError(Exception):
 
@@ -270,6 +320,59 @@ class OpcodeInfo:
                              'encoding' : '1011000' },
                    }
 
+    # Register specifiers, as the number encoded in a register field
+    register_numbers = {'R0' : 0, 'R1' : 1, 'R2' : 2, 'R3' : 3,
+                        'R4' : 4, 'R5' : 5, 'R6' : 6, 'R7' : 7}
+
+    # Bit position of each register field within the first word.  The
+    # 7-bit encoding occupies the top bits, [15:9].
+    field_shifts = (('field1', 6), ('field2', 3), ('field3', 0))
+
+    # Encoding templates, compiled from opcode_info by compile_templates()
+    templates = {}
+
+    # Operand checks, compiled from opcode_info by compile_validators()
+    validators = {}
+
+    @classmethod
+    def compile_templates(cls):
+        """ Precompute the integer encoding of every opcode, so that
+        assembling an instruction is a few integer operations.  A template
+        is a (base_word, register_fields, second_word) tuple, where
+            base_word is the encoding, already shifted into place
+            register_fields is a tuple of (operand_index, shift) pairs, one
+                for each field holding a register
+            second_word is the index of the operand which is the second
+                word of a long instruction (None for a short instruction)
+        Operand indices count from 0 (i.e. op1 is 0).
+        """
+        for opcode, info in cls.opcode_info.items():
+            base_word = int(info['encoding'], 2) << 9
+            register_fields = tuple((int(info[field][2:]) - 1, shift)
+                                    for field, shift in cls.field_shifts
+                                    if info[field] != 'zero')
+            if info['format'] == 'long':
+                second_word = int(info['second_word'][2:]) - 1
+            else:
+                second_word = None
+            cls.templates[opcode] = (base_word, register_fields, second_word)
+
+    @classmethod
+    def compile_validators(cls):
+        """ Precompute the checks on the operands of every opcode, so that
+        validating an instruction is a single lookup.  Each opcode gets a
+        tuple of checks (see operand_count_check and operand_type_check),
+        to be run in order on the AsmLine and the session's OperandCache.
+        """
+        for opcode, info in cls.opcode_info.items():
+            num_operands = info['num_operands']
+            checks = [operand_count_check(opcode, num_operands)]
+            for operand_number in range(1, num_operands + 1):
+                required_type = info['op%d_type' % (operand_number, )]
+                checks.append(operand_type_check(opcode, operand_number,
+                                                 required_type))
+            cls.validators[opcode] = tuple(checks)
+
     @classmethod
     def valid_opcode(cls, opcode):
         return opcode in cls.opcode_info
@@ -325,158 +428,262 @@ class OpcodeInfo:
     def format_is_long(cls, opcode):
         return cls.opcode_info[opcode]['format'] == 'long'
 
+def operand_count_check(opcode, num_required_operands):
+    """ Return a function of an AsmLine (and OperandCache), which raises a
+    SyntaxError unless the line has the number of operands required by the
+    opcode.
+    """
+    if num_required_operands == 0:
+        def check(line, operands):
+            if line.operand1:
+                raise SyntaxError(line.line_number,
+                                  "The " + opcode + " instruction requires " +
+                                  "no operands, but you provided one (" +
+                                  line.operand1 + ")")
+    elif num_required_operands == 1:
+        def check(line, operands):
+            if line.operand2:
+                raise SyntaxError(line.line_number,
+                                  "The " + opcode + " instruction requires " +
+                                  "one operand, but you provided two (" +
+                                  line.operand1 + " and " + line.operand2 + ")")
+            if not line.operand1:
+                raise SyntaxError(line.line_number,
+                                  "The " + opcode + " instruction requires " +
+                                  "one operand, but you provided none.")
+    elif num_required_operands == 2:
+        def check(line, operands):
+            if not line.operand1:
+                raise SyntaxError(line.line_number,
+                                  "The " + opcode + " instruction requires " +
+                                  "two operands, but you provided none.")
+            if not line.operand2:
+                raise SyntaxError(line.line_number,
+                                  "The " + opcode + " instruction requires " +
+                                  "two operands, but you provided one (" +
+                                  line.operand1 + ")")
+    elif num_required_operands == 3:
+        def check(line, operands):
+            if not line.operand1:
+                raise SyntaxError(line.line_number,
+                                  "The " + opcode + " instruction requires " +
+                                  "three operands, but you provided none.")
+            if not line.operand2:
+                raise SyntaxError(line.line_number,
+                                  "The " + opcode + " instruction requires " +
+                                  "three operands, but you provided one (" +
+                                  line.operand1 + ")")
+            if not line.operand3:
+                raise SyntaxError(line.line_number,
+                                  "The " + opcode + " instruction requires " +
+                                  "three operands, but you provided two (" +
+                                  line.operand1 + "and" + line.operand2 + ")")
+    else:
+        raise ValueError("DEBUG: Assembler couldn't validate opcode " + opcode)
+    return check
+
+def operand_type_check(opcode, operand_number, required_type):
+    """ Return a function of an AsmLine and OperandCache, which raises a
+    SyntaxError unless the given operand number (i.e. first, second, or
+    third) is of the required type.
+    """
+    operand_of = attrgetter('operand%d' % (operand_number, ))
+    operand_string = ('first', 'second', 'third')[operand_number - 1]
+    if required_type == 'register':
+        def check(line, operands):
+            operand = operand_of(line)
+            if operands.classify(operand)[0] != 'register':
+                raise SyntaxError(line.line_number,
+                                  "A " + opcode + " instruction " +
+                                  "requires the " + operand_string +
+                                  " operand be a register (R0-R7), " +
+                                  "but you provided " + operand)
+    else:
+        def check(line, operands):
+            operand = operand_of(line)
+            kind = operands.classify(operand)[0]
+            if kind == 'invalid':
+                raise SyntaxError(line.line_number,
+                                  "A " + opcode + " instruction " +
+                                  "requires the " + operand_string +
+                                  " operand be a label or hex value (like" +
+                                  " $01FF), but you provided " + operand)
+            if kind == 'register':
+                raise SyntaxError(line.line_number,
+                                  "A " + opcode + " statement " +
+                                  "requires the " + operand_string +
+                                  " operand not be a register, " +
+                                  "but you provided " + operand)
+    return check
+
+OpcodeInfo.compile_templates()
+OpcodeInfo.compile_validators()
+
+class LRUCache:
+    """ A dictionary of bounded size.  Once maxsize entries are held, adding
+    another forgets the least recently used one.  Counts the hits and misses
+    of get(), for tuning.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.table = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.table)
+
+    def clear(self):
+        self.table = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """ Return the value for key (None if it isn't cached) """
+        try:
+            value = self.table[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.table.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.table[key] = value
+        if len(self.table) > self.maxsize:
+            self.table.popitem(last=False)
+
+class OperandCache:
+    """ Classifies operand strings, remembering each classification so that
+    an operand used on many lines (R0-R7, common constants, loop labels) is
+    only examined once.  Each operand maps to a (kind, value) tuple:
+        ('register', register number)    e.g. R5
+        ('hex', integer value)           e.g. $01FF
+        ('label', None)                  e.g. LOOP.  The value is in the
+                                         symbol table, not known at parse time
+        ('invalid', None)                anything else
+    The number of distinct operands seen is len(cache).
+    """
+
+    def __init__(self):
+        self.table = {}
+
+    def __len__(self):
+        return len(self.table)
+
+    def clear(self):
+        self.table = {}
+
+    def classify(self, operand):
+        """ Return the (kind, value) tuple for the operand string """
+        try:
+            return self.table[operand]
+        except KeyError:
+            pass
+        if AsmLine.re_valop_reg.search(operand):
+            entry = ('register', int(operand[1:]))
+        elif AsmLine.re_valop_hex.search(operand):
+            entry = ('hex', int(operand[1:], 16))
+        elif AsmLine.re_vallabel.search(operand):
+            entry = ('label', None)
+        else:
+            entry = ('invalid', None)
+        self.table[operand] = entry
+        return entry
+
 class AsmLine:
-    """Class to represent a single line in the assembly file"""
-
-    # Any valid ASM line matches one of the following regular expressions
-    # A line without any fields
-    re_blank  = re.compile("""
-                           ^    # Start of line
-                           \s*  # 0+ whitespace chars
-                           $    # end of line
-                           """, re.VERBOSE)
-
-    # A line with only the label field
-    re_label =  re.compile("""
-                           ^      # Start of line
-                           (\S+)  # 1+ non-whitespace chars (group[0])
-                           \s*    # 0+ whitespace chars
-                           $      # end of line
-                           """, re.VERBOSE)
-
-    # A line with a label and an opcode
-    re_labop  = re.compile("""
-                           ^      # Start of line
-                           (\S+)  # 1+ non-whitespace chars (group[0])
-                           \s+    # 1+ whitespace chars
-                           (\S+)  # 1+ non-whitespace chars (group[1])
-                           \s*    # 0+ whitespace chars
-                           $      # end of line
-                           """, re.VERBOSE)
-
-    # A line with a label, opcode and one operand
-    re_labop1 = re.compile("""
-                           ^      # Start of line
-                           (\S+)  # 1+ non-whitespace chars (group[0])
-                           \s+    # 1+ whitespace chars
-                           (\S+)  # 1+ non-whitespace chars (group[1])
-                           \s+    # 1+ whitespace chars
-                           (\S+)  # 1+ non-whitespace chars (group[2])
-                           \s*    # 0+ whitespace chars
-                           $      # end of line
-                           """, re.VERBOSE)
-
-    # A line with a label, opcode and two operands
-    re_labop2 = re.compile("""
-                           ^      # Start of line
-                           (\S+)  # 1+ non-whitespace chars (group[0]:label)
-                           \s+    # 1+ whitespace chars
-                           (\S+)  # 1+ non-whitespace chars (group[1]:opcode)
-                           \s+    # 1+ whitespace chars
-                           (\S+)  # 1+ non-whitespace chars (group[2]:operand1)
-                           \s*    # 0+ whitespace chars
-                           ,      # A comma
-                           \s*    # 0+ whitespace chars
-                           (\S+)  # 1+ non-whitespace chars (group[3]:operand2)
-                           \s*    # 0+ whitespace chars
-                           $      # end of line
-                           """, re.VERBOSE)
-
-    # A line with a label, opcode and three operands
-    re_labop3 = re.compile("""
-                           ^      # Start of line
-                           (\S+)  # 1+ non-whitespace chars (group[0]:label)
-                           \s+    # 1+ whitespace chars
-                           (\S+)  # 1+ non-whitespace chars (group[1]:opcode)
-                           \s+    # 1+ whitespace chars
-                           (\S+)  # 1+ non-whitespace chars (group[2]:operand1)
-                           \s*    # 0+ whitespace chars
-                           ,      # A comma
-                           \s*    # 0+ whitespace chars
-                           (\S+)  # 1+ non-whitespace chars (group[3]:operand2)
-                           \s*    # 0+ whitespace chars
-                           ,      # A comma
-                           \s*    # 0+ whitespace chars
-                           (\S+)  # 1+ non-whitespace chars (group[4]:operand3)
-                           \s*    # 0+ whitespace chars
-                           $      # end of line
-                           """, re.VERBOSE)
-
-    # A line with just an opcode (no label)
-    re_opcode = re.compile("""
-                           ^      # Start of line
-                           \s+    # 1+ whitespace chars (no label)
-                           (\S+)  # 1+ non-whitespace chars ( group[0]:opcode)
-                           \s*    # 0+ whitespace chars
-                           $      # end of line
-                           """, re.VERBOSE)
-
-    # A line with an opcode and a single operand (no label)
-    re_op1    = re.compile("""
-                           ^      # Start of line
-                           \s+    # 1+ whitespace chars (no label)
-                           (\S+)  # 1+ non-whitespace chars (group[0]:opcode)
-                           \s+    # 1+ whitespace chars
-                           (\S+)  # 1+ non-whitespace chars (group[1]:operand1)
-                           \s*    # 0+ whitespace chars
-                           $      # end of line
-                           """, re.VERBOSE)
-
-    # A line with an opcode and two operands (no label)
-    re_op2    = re.compile("""
-                           ^      # Start of line
-                           \s+    # 1+ whitespace chars (no label)
-                           (\S+)  # 1+ non-whitespace chars (group[0]:opcode)
-                           \s+    # 1+ whitespace chars
-                           (\S+)  # 1+ non-whitespace chars (group[1]:operand1)
-                           \s*    # 0+ whitespace chars
-                           ,      # A comma
-                           \s*    # 0+ whitespace chars
-                           (\S+)  # 1+ non-whitespace chars (group[2]:operand2)
-                           \s*    # 0+ whitespace chars
-                           $      # end of line
-                           """, re.VERBOSE)
-
-    # A line with an opcode and three operands (no label)
-    re_op3    = re.compile("""
-                           ^      # Start of line
-                           \s+    # 1+ whitespace chars (no label)
-                           (\S+)  # 1+ non-whitespace chars (group[0]:opcode)
-                           \s+    # 1+ whitespace chars
-                           (\S+)  # 1+ non-whitespace chars (group[1]:operand1)
-                           \s*    # 0+ whitespace chars
-                           ,      # A comma
-                           \s*    # 0+ whitespace chars
-                           (\S+)  # 1+ non-whitespace chars (group[2]:operand2)
-                           \s*    # 0+ whitespace chars
-                           ,      # A comma
-                           \s*    # 0+ whitespace chars
-                           (\S+)  # 1+ non-whitespace chars (group[3]:operand3)
-                           \s*    # 0+ whitespace chars
-                           $      # end of line
-                           """, re.VERBOSE)
+    """Class to represent a single line in the assembly file.
+
+    Every line of a program is kept until the list file is written, so
+    lines are compact: attributes live in __slots__ (no per-line __dict__),
+    opcodes and operands are interned strings shared by all lines, and the
+    source text isn't kept (source_offset locates it, see source_line).
+    An assembled line takes 128 bytes (sys.getsizeof, 64-bit CPython 3.11),
+    plus its label string and any machine code word over 256, where the
+    same line with a __dict__ and its text took about 430 bytes.
+    """
+
+    __slots__ = ('opcode', 'label', 'operand1', 'operand2', 'operand3',
+                 'is_valid', 'word1', 'word2', 'line_number', 'mem_address',
+                 'is_pseudo_operation', 'source_offset')
+
+    is_blank = False
+
+    # Any valid ASM line matches this single regular expression.  The label
+    # (if any) starts in column 0; an opcode must be preceded by whitespace.
+    # The operand alternatives are tried with three operands first, then two,
+    # then one; else a comma without whitespace separating the operands
+    # would get viewed as a single operand.
+    re_statement = lazy_regex("""
+        ^                          # Start of line
+        (\S+)?                     # optional label in column 0 (group[0])
+        (?:                        # optional opcode and operands
+          \s+                      # 1+ whitespace chars
+          (\S+)                    # 1+ non-whitespace chars (group[1]:opcode)
+          (?:                      # optional operands
+            \s+                    # 1+ whitespace chars
+            (?:                    # either three operands
+              (\S+) \s* , \s*      #   group[2]:operand1, a comma
+              (\S+) \s* , \s*      #   group[3]:operand2, a comma
+              (\S+)                #   group[4]:operand3
+            |                      # OR two operands
+              (\S+) \s* , \s*      #   group[5]:operand1, a comma
+              (\S+)                #   group[6]:operand2
+            |                      # OR a single operand
+              (\S+)                #   group[7]:operand1
+            )
+          )?
+        )?
+        \s*                        # 0+ whitespace chars
+        $                          # end of line
+        """, re.VERBOSE)
+
+    # The same statement grammar, applied to a whole source buffer at once
+    # (see scan_statements).  Each match is one line of the file, including
+    # its newline.  Tokens stop at a ';' as the comment is part of the match,
+    # and whitespace may not run past the end of the line.  A line that is
+    # not a valid statement falls through to the last alternative, so that
+    # AsmLine can re-parse it and report the error.
+    re_source_line = lazy_regex(r"""
+        ^ (?=[\s\S])                 # Start of a line (not at end of buffer)
+        (?:
+          ([^\s;]+)?                  # optional label in column 0 (group[0])
+          (?:                         # optional opcode and operands
+            [^\S\n]+                   # 1+ whitespace chars on this line
+            ([^\s;]+)                 # opcode (group[1])
+            (?:                       # optional operands
+              [^\S\n]+
+              (?:                     # either three operands
+                ([^\s;]+) [^\S\n]* , [^\S\n]*   # group[2]:operand1, a comma
+                ([^\s;]+) [^\S\n]* , [^\S\n]*   # group[3]:operand2, a comma
+                ([^\s;]+)                        # group[4]:operand3
+              |                       # OR two operands
+                ([^\s;]+) [^\S\n]* , [^\S\n]*   # group[5]:operand1, a comma
+                ([^\s;]+)                        # group[6]:operand2
+              |                       # OR a single operand
+                ([^\s;]+)                        # group[7]:operand1
+              )
+            )?
+          )?
+          [^\S\n]*                    # 0+ whitespace chars
+          (?: ; [^\n]* )?              # optional comment
+          (?: \n | \Z )                # end of line
+        |                             # OR a line which can't be parsed
+          ([^\n]*) \n?                # (group[8])
+        )
+        """, re.VERBOSE | re.MULTILINE)
 
     # Validation regular expression: matches a label
-    re_vallabel  = re.compile("""
+    re_vallabel  = lazy_regex("""
                               ^      # Start of label (string)
                               \w+    # 1+ alphanumeric or underbar chars
                               $      # end of label (string)
                               """, re.VERBOSE)
 
-    # Validation RE: checks an operand is a number (hex or label)
-    re_valop_num = re.compile("""
-        ^                 # Start of operand (string)
-        (                 # either
-        \$                # the dollar sign (backspace escaped)
-        [0-9A-F]{1,4}     # [1-4] hex digits (number or letters A-F)
-        |                 # OR
-        \w+               # 1+ alphanumeric or underbar chars (this is a label)
-        )                 # end of either-or
-        $                 # end of operand (string
-      """, re.VERBOSE)
-
     # Validation RE: checks an operand is a register specifier
-    re_valop_reg = re.compile("""
+    re_valop_reg = lazy_regex("""
                               ^      # Start of line
                               R      # The letter R
                               [0-7]  # a number between 0 and 7
@@ -484,7 +691,7 @@ class AsmLine:
                               """, re.VERBOSE)
 
     # Validation RE: checks an operand is a hex number
-    re_valop_hex = re.compile("""
+    re_valop_hex = lazy_regex("""
           ^                 # Start of operand (string)
           \$                # the dollar sign (backspace escaped)
           [0-9A-F]{1,4}     # one to four hex digits (number or letters A-F)
@@ -492,29 +699,51 @@ class AsmLine:
           """, re.VERBOSE)
 
     # Validation RE: checks an opcode is a pseudo-operation
-    re_pseudo    = re.compile("""
+    re_pseudo    = lazy_regex("""
                               ^                 # Start of operand (string)
                               \.                # A period (backspace escaped)
                               (ORG|DW|EQU)      # Either ORG or DW or EQU
                               $                 # end of operand (string
                               """, re.VERBOSE)
 
-    def __init__(self, line, line_number, mem_address):
-        self.text = line
+    def __init__(self, line, line_number, mem_address, fields=None,
+                 source_offset=None, session=None):
+        """ fields, if given, are the groups of re_statement (or the first
+        eight groups of re_source_line) already matched against line.
+        source_offset is the position of line within the source text.
+        session is the AssemblerSession whose symbol table and caches are
+        used (AssemblerSession.default if None).
+        """
         self.opcode = None
         self.label  = None
         self.operand1 = None
         self.operand2 = None
         self.operand3 = None
         self.is_valid = False
-        self.is_blank = False
         self.word1 = None        # Memory contents (i.e. assembled machine code)
         self.word2 = None
         self.line_number = line_number
         self.mem_address = mem_address
         self.is_pseudo_operation = False
-        self.__parseInitial()
-        self.__validate()
+        self.source_offset = source_offset
+        if session is None:
+            session = AssemblerSession.default
+        if fields is None:
+            label, key = self.__split_label(line)
+        else:
+            label, key = fields[0], fields[1:]
+        statement = session.statement_cache.get(key)
+        if statement is None:
+            statement = self.__parse_statement(key, session.operand_cache)
+            session.statement_cache.put(key, statement)
+        (self.opcode, self.operand1, self.operand2, self.operand3,
+         is_pseudo, parse_error, opcode_error) = statement
+        if parse_error:
+            raise ParseError(self.line_number, parse_error)
+        self.is_valid = True
+        if label:
+            self.label = sys.intern(label.upper())
+        self.__validate(is_pseudo, opcode_error, session)
 
 
     def __str__(self):
@@ -575,6 +804,15 @@ class AsmLine:
         return '{} {} {}'.format(self.operand1, self.operand2, self.operand3)
 
 
+    def source_line(self, source_text):
+        """ Return the text of this line (without its newline), given the
+        text of the whole source file.
+        """
+        end = source_text.find('\n', self.source_offset)
+        if end < 0:
+            end = len(source_text)
+        return source_text[self.source_offset:end]
+
     def mem_locs(self):
         """ Return a list of (addr, data) tuples for defined memory
             locations.
@@ -589,214 +827,130 @@ class AsmLine:
             locs.append((self.mem_address + 2, self.word2))
         return locs
 
-    def __parseInitial(self):
-        """ Break the line into fields (label, opcode, operand1, operand2).
-        Remove any comments.
+    def __split_label(self, line):
+        """ Remove any comment, and split the line into its label (None if
+        there isn't one) and the rest of the statement, stripped of
+        whitespace.
         """
         # remove comments
-        c_index = self.text.find(';')
+        c_index = line.find(';')
         if c_index >= 0 :
-            p_line  = self.text[:c_index]  # Parse Line.  This is my scratchpad
+            p_line  = line[:c_index]  # Parse Line.  This is my scratchpad
         else :
-            p_line = self.text
-
-        # is the line blank?
-        match = self.re_blank.search(p_line)
-        if match:
-            self.is_valid = True
-            return
-
-        # is the line a label-only line?
-        match = self.re_label.search(p_line)
-        if match:
-            self.is_valid = True
-            self.label = match.groups()[0].upper()
-            return
-
-        # Does the line only have a label and operand?
-        match = self.re_labop.search(p_line)
-        if match:
-            self.is_valid = True
-            g = match.groups()
-            self.label  = g[0].upper()
-            self.opcode = g[1].upper()
-            return
-
-        # must check the three-operand versions before the two-operand, and so on; else
-        # a comma without whitespace separating the operands will get viewed as
-        # a single operand
-        match = self.re_labop3.search(p_line)
-        if match:
-            self.is_valid = True
-            g = match.groups()
-            self.label    = g[0].upper()
-            self.opcode   = g[1].upper()
-            self.operand1 = g[2].upper()
-            self.operand2 = g[3].upper()
-            self.operand3 = g[4].upper()
-            return
-
-        # Is this a 3 operand, no label line?
-        match = self.re_op3.search(p_line)
-        if match:
-            self.is_valid = True
-            g = match.groups()
-            self.opcode   = g[0].upper()
-            self.operand1 = g[1].upper()
-            self.operand2 = g[2].upper()
-            self.operand3 = g[3].upper()
-            return
-
-        match = self.re_labop2.search(p_line)
-        if match:
-            self.is_valid = True
-            g = match.groups()
-            self.label    = g[0].upper()
-            self.opcode   = g[1].upper()
-            self.operand1 = g[2].upper()
-            self.operand2 = g[3].upper()
-            return
-
-        # Is this a 2 operand, no label line?
-        match = self.re_op2.search(p_line)
-        if match:
-            self.is_valid = True
-            g = match.groups()
-            self.opcode   = g[0].upper()
-            self.operand1 = g[1].upper()
-            self.operand2 = g[2].upper()
-            return
-
-       # Opcode only line?
-        match = self.re_opcode.search(p_line)
-        if match:
-            self.is_valid = True
-            g = match.groups()
-            self.opcode = g[0].upper()
-            return
-
-        # Label + opcode + operand line?
-        match = self.re_labop1.search(p_line)
-        if match:
-            self.is_valid = True
-            g = match.groups()
-            self.label    = g[0].upper()
-            self.opcode   = g[1].upper()
-            self.operand1 = g[2].upper()
-            return
-
-        # Opcode + one operand?
-        match = self.re_op1.search(p_line)
-        if match:
-            self.is_valid = True
-            g = match.groups()
-            self.opcode   = g[0].upper()
-            self.operand1 = g[1].upper()
-            return
-
-        raise ParseError(self.line_number,
-                         """Line can't be parsed into label, opcode,
-                         operand fields""")
-
-
-    def __validate(self):
-        """ Check if the fields are actually valid labels, opcodes, etc.
-        Provide helpful error messages where possible.
+            p_line = line
+
+        if not p_line or p_line[0].isspace():
+            return None, p_line.strip()
+        fields = p_line.split(None, 1)
+        if len(fields) == 1:
+            return fields[0], ''
+        return fields[0], fields[1].strip()
+
+    def __parse_statement(self, key, operands):
+        """ Break the statement (a line without its label) into fields
+        (opcode, operand1, operand2, operand3), and validate the opcode and
+        operands.  None of this depends on the label or address of the line,
+        so the result can be reused by any line with the same statement.
+        key is the statement text, or the tuple of regex groups for it
+        already matched by scan_statements, and operands is the
+        OperandCache to classify the operands with.  Returns a tuple of
+            (opcode, operand1, operand2, operand3, is_pseudo,
+             parse_error, opcode_error)
+        where the errors are the reason_text of the ParseError or
+        SyntaxError to raise (or None).  Pseudo-operations can't be validated
+        here, as their rules depend on the label.
         """
+        if isinstance(key, tuple):
+            groups = key
+        else:
+            match = self.re_statement.search(' ' + key)
+            if not match:
+                return (None, None, None, None, False,
+                        """Line can't be parsed into label, opcode,
+                         operand fields""", None)
+            groups = match.groups()[1:]
+
+        (opcode, op3_1, op3_2, op3_3, op2_1, op2_2, op1_1) = groups
+        intern = sys.intern
+        if opcode:
+            self.opcode = intern(opcode.upper())
+        if op3_1:
+            self.operand1 = intern(op3_1.upper())
+            self.operand2 = intern(op3_2.upper())
+            self.operand3 = intern(op3_3.upper())
+        elif op2_1:
+            self.operand1 = intern(op2_1.upper())
+            self.operand2 = intern(op2_2.upper())
+        elif op1_1:
+            self.operand1 = intern(op1_1.upper())
+
+        is_pseudo = False
+        opcode_error = None
         if self.opcode:
-            match = self.re_pseudo.search(self.opcode)
-            if match:
-                self.__validate_pseudo_opcode(self.opcode)
+            if self.re_pseudo.search(self.opcode):
+                is_pseudo = True
             else:
-                self.__validate_opcode(self.opcode)
+                try:
+                    self.__validate_opcode(self.opcode, operands)
+                except SyntaxError as se:
+                    opcode_error = se.reason_text
+        return (self.opcode, self.operand1, self.operand2, self.operand3,
+                is_pseudo, None, opcode_error)
+
+    def __validate(self, is_pseudo, opcode_error, session):
+        """ Check if the fields are actually valid labels, opcodes, etc.
+        Provide helpful error messages where possible.  Instructions have
+        already been checked by __parse_statement, with any error message
+        in opcode_error.
+        """
+        if self.opcode:
+            if is_pseudo:
+                self.__validate_pseudo_opcode(self.opcode,
+                                              session.operand_cache)
+            elif opcode_error:
+                raise SyntaxError(self.line_number, opcode_error)
 
         if self.label:   # Requires .EQU has already been validated
-            self.__validate_label(self.label)
+            self.__validate_label(self.label, session)
 
         if self.label or self.opcode:
             self.__validate_memory_address()
 
 
-    def __validate_opcode(self, opcode):
+    def __validate_opcode(self, opcode, operands):
         """ An opcode must be a valid mnemonic.
         Check if the opcode has the proper number of operands.
         Then check if the operands are of the proper type.
+        The checks are built for each opcode by OpcodeInfo.compile_validators.
         """
-        if OpcodeInfo.invalid_opcode(opcode):
+        checks = OpcodeInfo.validators.get(opcode)
+        if checks is None:
             raise SyntaxError(self.line_number,
                               "Invalid opcode (%s)" % (opcode, ))
-        num_required_operands = OpcodeInfo.num_operands(opcode)
-        if num_required_operands == 0:
-            if self.operand1:
-                raise SyntaxError(self.line_number,
-                                  "The " + opcode + " instruction requires " +
-                                  "no operands, but you provided one (" +
-                                  self.operand1 + ")")
-        elif num_required_operands == 1:
-            if self.operand2:
-                raise SyntaxError(self.line_number,
-                                  "The " + opcode + " instruction requires " +
-                                  "one operand, but you provided two (" +
-                                  self.operand1 + " and " + self.operand2 + ")")
-            if not self.operand1:
-                raise SyntaxError(self.line_number,
-                                  "The " + opcode + " instruction requires " +
-                                  "one operand, but you provided none.")
-            self.__validate_operand_type(1)
-        elif num_required_operands == 2:
-            if not self.operand1:
-                raise SyntaxError(self.line_number,
-                                  "The " + opcode + " instruction requires " +
-                                  "two operands, but you provided none.")
-            if not self.operand2:
-                raise SyntaxError(self.line_number,
-                                  "The " + opcode + " instruction requires " +
-                                  "two operands, but you provided one (" +
-                                  self.operand1 + ")")
-            self.__validate_operand_type(1)
-            self.__validate_operand_type(2)
-        elif num_required_operands == 3:
-            if not self.operand1:
-                raise SyntaxError(self.line_number,
-                                  "The " + opcode + " instruction requires " +
-                                  "three operands, but you provided none.")
-            if not self.operand2:
-                raise SyntaxError(self.line_number,
-                                  "The " + opcode + " instruction requires " +
-                                  "three operands, but you provided one (" +
-                                  self.operand1 + ")")
-            if not self.operand3:
-                raise SyntaxError(self.line_number,
-                                  "The " + opcode + " instruction requires " +
-                                  "three operands, but you provided two (" +
-                                  self.operand1 + "and" + self.operand2 + ")")
-            self.__validate_operand_type(1)
-            self.__validate_operand_type(2)
-            self.__validate_operand_type(3)
-        else:
-            raise ValueError(self.line_number,
-                             "DEBUG: Assembler couldn't validate opcode " + opcode)
+        for check in checks:
+            check(self, operands)
 
-    def __validate_label(self, label):
+    def __validate_label(self, label, session):
         """ A label is valid if it matches the validation regular expression
         (which checks that it is one or more alphanumeric or _ characters).
         It also must not have already been declared (i.e. placed in the symbol
-        table).  A valid label will be placed in the symbol table by this
-        function.
+        table).  A valid label will be placed in the session's symbol table by
+        this function.
         """
         match = self.re_vallabel.search(label)
         if match:
             if (self.opcode == ".EQU"):
-                val = int(self.operand1[1:], 16);
-                SymbolTable.add_label(label, val, self.line_number)
+                val = session.operand_cache.classify(self.operand1)[1]
+                session.symbols.add_label(label, val, self.line_number)
             else:
-                SymbolTable.add_label(label, self.mem_address, self.line_number)
+                session.symbols.add_label(label, self.mem_address,
+                                          self.line_number)
         else:
             raise SyntaxError(self.line_number, "Invalid label (" + label +
                               ").  Labels may only consist of alphanumeric " +
                               "or underbar characters.")
 
-    def __validate_pseudo_opcode(self, p_opcode):
+    def __validate_pseudo_opcode(self, p_opcode, operands):
         """ Check the Pseudo operation has the required number
         and type of operands
         """
@@ -823,8 +977,8 @@ class AsmLine:
                 raise SyntaxError(self.line_number,
                                   "A .EQU pseudo-operation requires one " +
                                   "operand, but you provided none.")
-            match = self.re_valop_hex.search(self.operand1)
-            if not match:
+            kind = operands.classify(self.operand1)[0]
+            if kind != 'hex':
                 raise SyntaxError(self.line_number,
                                   "A .EQU pseudo-operation requires the " +
                                   "operand be a hex value (like $01FF), but " +
@@ -846,9 +1000,8 @@ class AsmLine:
                                   self.operand1 + " and " + self.operand2 +
                                   ")")
             if self.operand1:
-                match_hex = self.re_valop_hex.search(self.operand1)
-                match_label = self.re_vallabel.search(self.operand1)
-                if not (match_hex or match_label):
+                kind = operands.classify(self.operand1)[0]
+                if kind == 'invalid':   # a hex value or any label (even R0-R7)
                     raise SyntaxError(self.line_number,
                                       "A .DW pseudo-operation requires the " +
                                       "operand be a hex value (like $01FF), " +
@@ -879,56 +1032,14 @@ class AsmLine:
                 raise SyntaxError(self.line_number,
                                   "A .ORG pseudo-operation requires one " +
                                   "operand, but you provided none.")
-            match = self.re_valop_hex.search(self.operand1)
-            if not match:
+            kind = operands.classify(self.operand1)[0]
+            if kind != 'hex':
                 raise SyntaxError(self.line_number,
                                   "A .ORG pseudo-operation requires the " +
                                   "operand be a hex value (like $01FF), but " +
                                   "you provided " + self.operand1)
         self.is_pseudo_operation = True
 
-    def __validate_operand_type(self, operand_number):
-        """ Check that the given operand number (i.e. first, second, or third)
-        is of the proper type.  Check against the validation regular
-        expressions.
-        """
-        if operand_number == 1:
-            operand = self.operand1
-            required_type = OpcodeInfo.operand1_type(self.opcode)
-            operand_string = "first"
-        elif operand_number == 2:
-            operand = self.operand2
-            required_type = OpcodeInfo.operand2_type(self.opcode)
-            operand_string = "second"
-        else:
-            operand = self.operand3
-            required_type = OpcodeInfo.operand3_type(self.opcode)
-            operand_string = "third"
-
-        if required_type == 'register':
-            match = self.re_valop_reg.search(operand)
-            if not match:
-                raise SyntaxError(self.line_number,
-                                  "A " + self.opcode + " instruction " +
-                                  "requires the " + operand_string +
-                                  " operand be a register (R0-R7), " +
-                                  "but you provided " + operand)
-        else:
-            match = self.re_valop_num.search(operand)
-            if not match:
-                raise SyntaxError(self.line_number,
-                                  "A " + self.opcode + " instruction " +
-                                  "requires the " + operand_string +
-                                  " operand be a label or hex value (like" +
-                                  " $01FF), but you provided " + operand)
-            match = self.re_valop_reg.search(operand)
-            if match:
-                raise SyntaxError(self.line_number,
-                                  "A " + self.opcode + " statement " +
-                                  "requires the " + operand_string +
-                                  " operand not be a register, " +
-                                  "but you provided " + operand)
-
     def __validate_memory_address(self):
         """ Check that a memory address has already been initialized
         (via .ORG) prior to this statement.  This function will be
@@ -952,7 +1063,7 @@ class AsmLine:
         and a long instruction takes four).
         """
         if self.opcode == ".ORG":
-            return int(self.operand1[1:], 16)  #operand1 hex string to integer
+            return int(self.operand1[1:], 16)   # validated as hex
         elif self.mem_address == None:     # beginning of a file, before an ORG
             return None
         elif self.opcode == ".EQU":
@@ -964,123 +1075,133 @@ class AsmLine:
         else:
             return self.mem_address
 
-    def assemble(self):
-        ''' Figure out what the machine words are for this instruction.'''
+    def assemble(self, session=None):
+        ''' Figure out what the machine words are for this instruction.
+        Labels are looked up in the session's symbol table.'''
         if not self.opcode:
             return
+        if session is None:
+            session = AssemblerSession.default
         if self.opcode == '.DW':
-            try:
-                self.word1 = SymbolTable.lookup_label(self.operand1, self.line_number);
-            except SyntaxError:
-                self.word1 = int(self.operand1[1:], 16)
+            if self.operand1:
+                self.word1 = self.__assemble_long(self.operand1, session)
+            else:
+                self.word1 = 0      # Reserves a word
             return
         elif self.opcode == '.EQU' or self.opcode == '.ORG':
             return
+        (base_word, register_fields,
+         second_word) = OpcodeInfo.templates[self.opcode]
+        operands = (self.operand1, self.operand2, self.operand3)
+        register_numbers = OpcodeInfo.register_numbers
+        for operand_index, shift in register_fields:
+            base_word |= register_numbers[operands[operand_index]] << shift
+        self.word1 = base_word
+        if second_word is not None:
+            self.word2 = self.__assemble_long(operands[second_word], session)
+
+    def undefined_label(self, session=None):
+        """ Return the label operand that assemble() needs, if the label
+        hasn't been defined (yet) in the session.  Otherwise return None.
+        """
+        if session is None:
+            session = AssemblerSession.default
+        if self.opcode == '.DW':
+            operand = self.operand1
+        elif self.opcode in OpcodeInfo.templates:
+            second_word = OpcodeInfo.templates[self.opcode][2]
+            if second_word is None:
+                return None
+            operand = (self.operand1, self.operand2,
+                       self.operand3)[second_word]
         else:
-            mach_code = (OpcodeInfo.encoding_is(self.opcode) +
-                    self.__assemble_field(OpcodeInfo.field1_is(self.opcode)) +
-                    self.__assemble_field(OpcodeInfo.field2_is(self.opcode)) +
-                    self.__assemble_field(OpcodeInfo.field3_is(self.opcode))
-                    )
-            self.word1 = int(mach_code, 2)
-        if OpcodeInfo.format_is_long(self.opcode):
-            self.word2 = self.__assemble_long(self.opcode)
+            return None
+        if not operand or session.operand_cache.classify(operand)[0] == 'hex':
+            return None
+        if session.symbols.has_label(operand):
+            return None
+        return operand
 
-    def __assemble_register(self, reg_string):
-        """ Given a string like R4, return the 3 character binary string
-        representing the register number (i.e. '100').  This value will be
-        used when assembling the register fields of the instruction.
-        """
-        if reg_string == 'R0':
-            return '000'
-        if reg_string == 'R1':
-            return '001'
-        if reg_string == 'R2':
-            return '010'
-        if reg_string == 'R3':
-            return '011'
-        if reg_string == 'R4':
-            return '100'
-        if reg_string == 'R5':
-            return '101'
-        if reg_string == 'R6':
-            return '110'
-        if reg_string == 'R7':
-            return '111'
-        raise ValueError("DEBUG: Invalid register string: " + reg_string)
-
-    def __assemble_field(self, field_string):
-        """ Given a string representing what goes in a field
-        (i.e. zero, op1, op2) return the binary string for that field.
-        """
-        if field_string == 'zero':
-           return '000'
-        elif field_string == 'op1':
-           return self.__assemble_register(self.operand1)
-        elif field_string == 'op2':
-           return self.__assemble_register(self.operand2)
-        elif field_string == 'op3':
-           return self.__assemble_register(self.operand3)
-        raise ValueError("DEBUG: Invalid field string: " + field_string)
-
-    def __assemble_long(self, opcode):
+    def __assemble_long(self, val, session):
         """ Return the integer value of what the machine code is for
-        the second word of a long format instruction.
+        the second word of a long format instruction (or a .DW), given the
+        operand.
         """
-        if OpcodeInfo.second_word_is(opcode) == 'op1':
-          val = self.operand1
-        elif OpcodeInfo.second_word_is(opcode) == 'op2':
-          val = self.operand2
-        elif OpcodeInfo.second_word_is(opcode) == 'op3':
-          val = self.operand3
+        kind, value = session.operand_cache.classify(val)
+        if kind == 'hex':
+            return value
         else:
-          raise ValueError("DEBUG: Invalid second_word in opcode_info for " + opcode)
+            return session.symbols.lookup_label(val, self.line_number)
+
+class default_symbols:
+    """ Descriptor for the attributes of SymbolTable.  There used to be a
+    single symbol table, held by the class, so code still uses
+    SymbolTable.lookup_label(...), SymbolTable.clear(), SymbolTable.table.
+    Looked up on the class, an attribute is that of the symbol table of
+    AssemblerSession.default.  Looked up on a SymbolTable, it's the table's
+    own (a method is bound to it, and table is in its __dict__).
+    """
 
-        match = self.re_valop_hex.search(val)
-        if match:
-            return int(val[1:], 16) # The operand is a hex string, so int it.
-        else:
-            return SymbolTable.lookup_label(val, self.line_number)
+    def __init__(self, function=None):
+        self.function = function
+        self.__doc__ = function.__doc__ if function else None
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            instance = AssemblerSession.default.symbols
+            if self.function is None:
+                return getattr(instance, self.name)
+        return self.function.__get__(instance, owner)
 
 class SymbolTable:
 
-    table = {}
+    table = default_symbols()
 
-    @classmethod
-    def add_label(cls, label, mem_address, line_number):
-        if label in cls.table:
+    def __init__(self):
+        self.table = {}
+
+    @default_symbols
+    def add_label(self, label, mem_address, line_number):
+        if label in self.table:
             raise SyntaxError(line_number, "Duplicate label (" + label +
                               ").  Label has already been declared on a " +
                               "previous line.")
-        cls.table[label] = mem_address
+        self.table[label] = mem_address
 
-    @classmethod
-    def lookup_label(cls, label, line_number):
+    @default_symbols
+    def has_label(self, label):
+        return label in self.table
+
+    @default_symbols
+    def lookup_label(self, label, line_number):
         """ returns mem_address """
-        if label in cls.table:
-            return cls.table[label]
+        if label in self.table:
+            return self.table[label]
         else:
             raise SyntaxError(line_number,
                               "The label " + label +
                               " has not been defined anywhere.")
 
-    @classmethod
-    def clear(cls):
+    @default_symbols
+    def clear(self):
         """
         Deletes all symbols in the symbol table.  Primarily used for
         testing.  Not anticipated to be used in normal assembly.
         """
-        cls.table = {}
+        self.table = {}
 
-    @classmethod
-    def printable_string(cls):
-        if not cls.table:
+    @default_symbols
+    def printable_string(self):
+        if not self.table:
             return "Symbol table is empty"
         else:
             max_len = 0
             long_label = False
 
-            for key in cls.table.keys():
+            for key in self.table.keys():
                 if len(key) > max_len:
                     max_len = len(key)
 
@@ -1094,7 +1215,7 @@ class SymbolTable:
             ret_val = "{0:^{1}}  Address\n{2}  -------\n".format('Label',
                       max_len, '-' * max_len)
 
-            for label, address in sorted(cls.table.items()):
+            for label, address in sorted(self.table.items()):
                 printable_label = label
                 if len(label) > 40:
                     printable_label = label[:40]
@@ -1106,18 +1227,1245 @@ class SymbolTable:
             return ret_val
 
 
+class AssemblerSession:
+    """ Everything one assembly remembers: its symbol table, the caches of
+    classified operands and parsed statements, its options (from the
+    command line, or None) and the syntax errors found (diagnostics, see
+    report).  Sessions share nothing that changes, so any
+    number of them can assemble at once (e.g. on a thread pool) without
+    locking.  AsmLine and the assembly functions take a session, and use
+    AssemblerSession.default if they aren't given one.
+    """
+
+    default = None      # set below
+
+    def __init__(self, options=None):
+        self.options = options
+        self.symbols = SymbolTable()
+        # Kind and value of every operand seen
+        self.operand_cache = OperandCache()
+        # Parsed and validated statements, keyed on the comment-stripped
+        # text of the line without its label (see AsmLine.__parse_statement).
+        # Generated code repeats the same instructions at many addresses.
+        self.statement_cache = LRUCache(maxsize=4096)
+        self.diagnostics = []
+
+    def clear(self):
+        """ Forget all symbols, diagnostics, and cached operands and
+        statements.
+        """
+        self.symbols.clear()
+        self.operand_cache.clear()
+        self.statement_cache.clear()
+        self.diagnostics = []
+
+    def report(self, error):
+        """ Record a SyntaxError (or ParseError) in the diagnostics.  Returns
+        True if there are now too many errors to carry on.
+        """
+        self.diagnostics.append(error)
+        return len(self.diagnostics) > MAX_SYNTAX_ERRORS
+
+AssemblerSession.default = AssemblerSession()
+
+
+def assemble_columnar(code, session=None):
+    """ Assemble a whole program at once with NumPy, rather than by calling
+    assemble() on every line.  The validated lines (from the first pass)
+    are lowered into parallel arrays: an opcode index, the register numbers
+    of the three operands, the immediate value or label reference of the
+    operand which becomes a word, and the size of each line.  Addresses are
+    a cumulative sum of the sizes, restarting at every .ORG.  The machine
+    code words are then computed with vectorized shifts and ors.
+
+    The words are stored back into the lines (word1 and word2), for the
+    list file.  Labels are looked up in the session (default if None).
+    Returns the (addr, data) memory locations, in the same order the lines'
+    mem_locs() would give them.
+    """
+    if session is None:
+        session = AssemblerSession.default
+    numpy = load_numpy()
+
+    # Per-opcode tables, indexed by opcode index.  The pseudo-operations come
+    # first.  field_source says which operand (1-3) goes into each register
+    # field, 0 for a field which is always zero.  value_operand is the
+    # operand (1-3) which becomes the value or second word, 0 for none.
+    opcodes = ['.ORG', '.EQU', '.DW'] + sorted(OpcodeInfo.templates)
+    opcode_index = {opcode: index for index, opcode in enumerate(opcodes)}
+    base_word = numpy.zeros(len(opcodes), dtype=numpy.int64)
+    size = numpy.zeros(len(opcodes), dtype=numpy.int64)
+    field_source = numpy.zeros((len(opcodes), 3), dtype=numpy.intp)
+    value_operand = numpy.zeros(len(opcodes), dtype=numpy.intp)
+    size[2] = 2
+    value_operand[0:3] = 1
+    for index, opcode in enumerate(opcodes[3:], 3):
+        (base_word[index], register_fields,
+         second_word) = OpcodeInfo.templates[opcode]
+        size[index] = OpcodeInfo.operation_size(opcode)
+        for operand_index, shift in register_fields:
+            field_source[index, 2 - shift // 3] = operand_index + 1
+        if second_word is not None:
+            value_operand[index] = second_word + 1
+
+    # Lower the program into columns
+    op = []
+    reg1 = []
+    reg2 = []
+    reg3 = []
+    immediate = []
+    label_ref = []
+    labels = {}         # label -> index into label_ref's symbol values
+    label_rows = []     # the first row referring to each label
+    value_operands = value_operand.tolist()
+    classify = session.operand_cache.classify
+    for row, line in enumerate(code):
+        index = opcode_index[line.opcode] if line.opcode else 1
+        op.append(index)        # a label-only line is like a .EQU
+        registers = [0, 0, 0, 0]
+        operands = (None, line.operand1, line.operand2, line.operand3)
+        for operand_number in (1, 2, 3):
+            operand = operands[operand_number]
+            if operand is None:
+                break
+            kind, value = classify(operand)
+            if kind == 'register':
+                registers[operand_number] = value
+        reg1.append(registers[1])
+        reg2.append(registers[2])
+        reg3.append(registers[3])
+        operand = operands[value_operands[index]]
+        kind, value = classify(operand) if operand else ('hex', 0)
+        if kind == 'hex':
+            immediate.append(value)
+            label_ref.append(-1)
+        else:
+            immediate.append(0)
+            if operand not in labels:
+                labels[operand] = len(labels)
+                label_rows.append(row)
+            label_ref.append(labels[operand])
+
+    # Look up the labels.  Report the first line (in program order) which
+    # refers to an undefined label, as assembling line by line would.
+    symbol_values = [0] * (len(labels) + 1)     # [-1] is for no label
+    undefined = []
+    for label, index in labels.items():
+        try:
+            symbol_values[index] = session.symbols.lookup_label(label, None)
+        except SyntaxError:
+            undefined.append(label_rows[index])
+    if undefined:
+        line = code[min(undefined)]
+        line.assemble(session)  # raises the SyntaxError for the line
+
+    count = len(code)
+    op = numpy.array(op, dtype=numpy.intp)
+    registers = numpy.array([[0] * count, reg1, reg2, reg3],
+                            dtype=numpy.int64).T
+    immediate = numpy.array(immediate, dtype=numpy.int64)
+    label_ref = numpy.array(label_ref, dtype=numpy.intp)
+    symbol_values = numpy.array(symbol_values, dtype=numpy.int64)
+
+    # Addresses: a running total of sizes, offset to each .ORG's operand
+    sizes = size[op]
+    start = numpy.cumsum(sizes) - sizes
+    is_org = op == 0
+    offset = numpy.where(is_org, immediate - start, 0)
+    segment = numpy.maximum.accumulate(numpy.where(is_org,
+                                                   numpy.arange(count), 0))
+    address = start + offset[segment]
+
+    # Encode
+    value = numpy.where(label_ref >= 0, symbol_values[label_ref], immediate)
+    rows = numpy.arange(count)
+    fields = field_source[op]
+    word1 = (base_word[op] |
+             registers[rows, fields[:, 0]] << 6 |
+             registers[rows, fields[:, 1]] << 3 |
+             registers[rows, fields[:, 2]])
+    word1 = numpy.where(op == 2, value, word1)     # a .DW is just its value
+    has_word1 = sizes > 0
+    has_word2 = sizes == 4
+
+    for line, w1, w2, h1, h2 in zip(code, word1.tolist(), value.tolist(),
+                                    has_word1.tolist(), has_word2.tolist()):
+        if h1:
+            line.word1 = w1
+        if h2:
+            line.word2 = w2
+
+    addrs = numpy.stack((address, address + 2), axis=1)
+    words = numpy.stack((word1, value), axis=1)
+    present = numpy.stack((has_word1, has_word2), axis=1)
+    return list(zip(addrs[present].tolist(), words[present].tolist()))
+
+
+def scan_statements(asm_text):
+    """ Split the whole text of an assembly file into statements, with a
+    single pass of AsmLine.re_source_line over the buffer.  Yields a
+    (line, fields) pair for each line of the file.  fields are the
+    statement groups to hand to AsmLine, or None for a line which doesn't
+    parse (AsmLine will re-parse it, to report the error).  A line seen
+    before (one of the first KNOWN_LINES distinct lines) is looked up
+    rather than matched again, and the scan carries on after it.
+    """
+    match = AsmLine.re_source_line.match
+    find = asm_text.find
+    known = {}          # line -> fields
+    position, size = 0, len(asm_text)
+    while position < size:
+        end = find('\n', position) + 1 or size
+        line = asm_text[position:end]
+        try:
+            fields = known[line]
+        except KeyError:
+            m = match(asm_text, position)
+            fields = None if m.lastindex == 9 else m.groups()[:8]
+            if len(known) < KNOWN_LINES:
+                known[line] = fields
+        yield line, fields
+        position = end
+
+# Distinct lines scan_statements remembers
+KNOWN_LINES = 4096
+
+def first_pass(statements, session=None):
+    """ First pass, assemble as much as possible.  Build symbol table.
+    statements are (line, fields) pairs, as from scan_statements.  Labels
+    go in the session's symbol table (default if None).  Syntax
+    errors are reported to the session; the pass stops at a ParseError, or
+    after too many syntax errors.  Returns the list of AsmLine objects
+    (without blank lines).
+    """
+    if session is None:
+        session = AssemblerSession.default
+    line_number = 1
+    mem_address = None  # In case there is no .ORG statement, need to detect
+    code = []  # List of AsmLine objects
+
+    source_offset = 0
+    for line, fields in statements:
+        line_offset = source_offset
+        source_offset += len(line)
+        if fields and not (fields[0] or fields[1]):
+            line_number += 1    # A blank line, nothing to assemble
+            continue
+        try:
+            a = AsmLine(line, line_number, mem_address, fields, line_offset,
+                        session)
+            if a.label or a.opcode:   # Blank lines aren't kept
+                code.append(a)
+            line_number += 1
+            mem_address = a.next_mem_address()
+        except SyntaxError as se:
+            if session.report(se):
+                break
+        except ParseError as pe:
+            session.report(pe)
+            break
+    return code
+
+def parse_chunk(chunk):
+    """ Worker for parse_parallel: parse and validate a chunk of lines.
+    chunk is (first_index, lines, at_start), where first_index is the
+    (0-based) index of the first line in the file.  The chunk is assembled
+    in a session of its own.  Unless the chunk is
+    at the start of the file, the address it starts at isn't known, so
+    addresses are relative to the start of the chunk until its first .ORG.
+    Returns (records, relative, end_address): one record per non-blank
+    line, and the address after the chunk (relative, if still so).  A
+    record is one of
+        ('line', index, AsmLine, relative)
+        ('error', index, reason_text, (label, value) or None)  a SyntaxError
+                which happened after the line's label was defined
+        ('parse', index, reason_text, None)   a ParseError, the last record
+    """
+    first_index, lines, at_start = chunk
+    session = AssemblerSession()  # Labels are checked against other chunks
+    symbols = session.symbols.table
+    relative = not at_start
+    mem_address = 0 if relative else None
+    records = []
+    for index, line in enumerate(lines, first_index):
+        num_labels = len(symbols)
+        try:
+            a = AsmLine(line, index + 1, mem_address, session=session)
+        except SyntaxError as se:
+            defined = None
+            if len(symbols) > num_labels:
+                label = next(reversed(symbols))
+                defined = (label, symbols[label])
+            records.append(('error', index, se.reason_text, defined))
+            continue
+        except ParseError as pe:
+            records.append(('parse', index, pe.reason_text, None))
+            break
+        if not (a.label or a.opcode):
+            continue
+        records.append(('line', index, a, relative))
+        mem_address = a.next_mem_address()
+        if a.opcode == '.ORG':
+            relative = False
+    return records, relative, mem_address
+
+def parse_parallel(lines, jobs, chunk_size=None, session=None):
+    """ Do the work of first_pass() on a pool of jobs processes.  The lines
+    are split into chunks, which are parsed and validated independently
+    (parse_chunk).  Then the chunk addresses are added up in order, turning
+    relative addresses into absolute ones, and the labels of the chunks are
+    merged, checking for duplicates.  Syntax errors are reported to the
+    session exactly as first_pass() would.  The labels go in the session's
+    symbol table (default if None).  Returns the list of AsmLine objects.
+    """
+    if session is None:
+        session = AssemblerSession.default
+    if chunk_size is None:
+        chunk_size = max(1000, len(lines) // (jobs * 4) + 1)
+    chunks = [(start, lines[start:start + chunk_size], start == 0)
+              for start in range(0, len(lines), chunk_size)]
+    import multiprocessing
+    with multiprocessing.Pool(jobs) as pool:
+        results = pool.map(parse_chunk, chunks)
+
+    code = []
+    symbols = {}
+    syntax_errors = 0
+    mem_address = None
+    for records, relative_end, end_address in results:
+        base = mem_address
+        for kind, index, item, extra in records:
+            # Line numbers don't count lines with errors (as in first_pass)
+            line_number = index + 1 - syntax_errors
+            if kind == 'parse':
+                session.report(ParseError(line_number, item))
+                return code
+            if kind == 'line':
+                a, relative = item, extra
+                a.line_number = line_number
+                if relative and base is not None:
+                    a.mem_address += base
+                elif relative:
+                    a.mem_address = None
+                error = None
+                if a.label in symbols:
+                    error = ("Duplicate label (" + a.label +
+                             ").  Label has already been declared on a " +
+                             "previous line.")
+                elif a.label:
+                    if a.opcode == '.EQU':
+                        symbols[a.label] = session.operand_cache.classify(
+                                                    a.operand1)[1]
+                    else:
+                        symbols[a.label] = a.mem_address
+                if (not error and a.mem_address is None and
+                    a.opcode not in ('.ORG', '.EQU')):
+                    error = ("You must use .ORG to initialize a memory " +
+                             "section before any line with a label or " +
+                             "opcode")
+                if not error:
+                    code.append(a)
+                    continue
+            else:
+                error = item
+                if extra and extra[0] not in symbols:
+                    symbols[extra[0]] = extra[1]
+            syntax_errors += 1
+            if session.report(SyntaxError(line_number, error)):
+                return code
+        if not relative_end:
+            mem_address = end_address
+        elif base is not None:
+            mem_address = base + end_address
+
+    if syntax_errors > 0:
+        return code
+    session.symbols.clear()
+    for label, value in symbols.items():
+        session.symbols.add_label(label, value, None)
+    return code
+
+def assemble_one_pass(statements, listing, session=None):
+    """ Assemble in a single pass over the statements, listing lines as it
+    goes.  A line which refers to a label that isn't defined yet waits until
+    the label is defined, and is then assembled; the lines after it wait to
+    be listed too (to keep the listing in order), but only as their list
+    file text.  Every other line is assembled, listed and dropped straight
+    away.  Syntax errors are reported to the session as in first_pass(), and
+    labels still undefined at the end are reported as syntax errors (if
+    there were no others, as in two-pass).
+    Labels go in the session's symbol table (default if None).  listing is
+    called with the list file text of each line (until there is an error),
+    as soon as it can be.  Returns the (addr, data) memory locations.
+    """
+    if session is None:
+        session = AssemblerSession.default
+    line_number = 1
+    mem_address = None  # In case there is no .ORG statement, need to detect
+    mem_locs = []
+    waiting = {}        # label -> lines waiting for it to be defined
+    unresolved = set()  # lines waiting for a label
+    pending = deque()   # lines not yet listed, in order: the AsmLines
+                        # waiting for labels, (text, mem_locs) of the rest
+
+    def flush():
+        """ List the pending lines up to the first unresolved one """
+        while pending:
+            c = pending[0]
+            if isinstance(c, AsmLine):
+                if c in unresolved:
+                    return
+                c = (str(c), c.mem_locs())      # Since assembled
+            pending.popleft()
+            if c[0] != "":
+                listing(c[0])
+                mem_locs.extend(c[1])
+
+    for line, fields in statements:
+        if fields and not (fields[0] or fields[1]):
+            line_number += 1    # A blank line, nothing to assemble
+            continue
+        try:
+            a = AsmLine(line, line_number, mem_address, fields,
+                        session=session)
+            line_number += 1
+            mem_address = a.next_mem_address()
+        except SyntaxError as se:
+            if session.report(se):
+                return mem_locs
+            continue
+        except ParseError as pe:
+            session.report(pe)
+            return mem_locs
+        if a.label in waiting:
+            for w in waiting.pop(a.label):
+                w.assemble(session)
+                unresolved.discard(w)
+        if not a.opcode:
+            continue
+        label = a.undefined_label(session)
+        if label:
+            waiting.setdefault(label, []).append(a)
+            unresolved.add(a)
+            pending.append(a)
+        else:
+            a.assemble(session)
+            pending.append((str(a), a.mem_locs()))
+        if not session.diagnostics:
+            flush()
+
+    if session.diagnostics:
+        return mem_locs     # As two-pass, which doesn't get to the labels
+    for c in sorted(unresolved, key=attrgetter('line_number')):
+        try:
+            c.assemble(session)
+        except SyntaxError as se:
+            if session.report(se):
+                return mem_locs
+    unresolved.clear()
+    if not session.diagnostics:
+        flush()
+    return mem_locs
+
+def write_list_header(file):
+    print("addr data   label     opcode  operands", file=file)
+    print("---- ----  --------   ------  --------", file=file)
+
+class Program:
+    """ An assembled program, as returned by assemble().
+        mem_locs : the (addr, data) memory locations, in program order
+        symbols : the symbol table, a dict of label -> value
+        listing : the list file text of each line with machine code (two
+            lines of text for a long instruction), without the header; None
+            if the list file was written as the program assembled
+        diagnostics : the SyntaxError and ParseError exceptions, in order.
+            If there are any, nothing was assembled (there are no mem_locs
+            and no listing)
+    The write_ methods write the output files to open file objects; nothing
+    is written anywhere else.  The options (if any) choose their formats.
+    """
+
+    def __init__(self, session, mem_locs, listing, options=None):
+        self.session = session
+        self.options = options
+        self.symbols = session.symbols.table
+        self.diagnostics = session.diagnostics
+        if self.diagnostics:
+            mem_locs = []
+            if listing is not None:
+                listing = []
+        self.mem_locs = mem_locs
+        self.listing = listing
+
+    @property
+    def ok(self):
+        return not self.diagnostics
+
+    def write_list(self, file):
+        write_list_header(file)
+        for s in self.listing:
+            print(s, file=file)
+
+    def write_symbols(self, file):
+        print(self.session.symbols.printable_string(), file=file)
+
+    def write_mem(self, file):
+        sparse = self.options is not None and self.options.sparse
+        create_mem_file(file, self.mem_locs, sparse)
+
+    def write_mif(self, file):
+        create_mif_file(file, self.mem_locs)
+
+    @property
+    def writes_bin(self):
+        """ Whether the options ask for a binary image """
+        return self.options is not None and self.options.bin_file is not None
+
+    def write_bin(self, file):
+        create_bin_file(file, self.mem_locs, self.options.bin_span)
+
+    @property
+    def writes_ihex(self):
+        """ Whether the options ask for an Intel HEX file """
+        return self.options is not None and self.options.ihex_file is not None
+
+    def write_ihex(self, file):
+        create_ihex_file(file, self.mem_locs)
+
+def source_statements(source, options):
+    """ The statements (line, source_offset) of source, the text of an ASM
+    file or an iterable of its lines, as first_pass takes them.
+    """
+    if options.whole_file:
+        if not isinstance(source, str):
+            source = ''.join(source)
+        return scan_statements(source)
+    lines = io.StringIO(source) if isinstance(source, str) else source
+    return ((line, None) for line in lines)
+
+def parse_program(source, options, session):
+    """ The first pass of assemble(): parse and validate the lines of
+    source, on options.jobs processes.  Returns the code; syntax errors are
+    reported to the session.
+    """
+    if options.jobs > 1:
+        lines = io.StringIO(source) if isinstance(source, str) else source
+        return parse_parallel(list(lines), options.jobs, session=session)
+    return first_pass(source_statements(source, options), session)
+
+def check_program(source, options=None, session=None):
+    """ Check a program for errors without assembling it: parse and
+    validate its lines, then check that the labels they use are defined.
+    Nothing is encoded or listed.  source, options and session are as for
+    assemble().  Returns the diagnostics assemble() would give.
+    """
+    if options is None:
+        options = default_options()
+    if session is None:
+        session = AssemblerSession(options)
+    code = parse_program(source, options, session)
+    if not session.diagnostics:
+        try:
+            for c in code:
+                label = c.undefined_label(session)
+                if label:
+                    session.symbols.lookup_label(label, c.line_number)
+        except SyntaxError as se:
+            session.report(se)
+    return session.diagnostics
+
+def assemble(source, options=None, session=None, list_file=None):
+    """ Assemble a program in memory.  source is the text of an ASM file,
+    or an iterable of its lines (such as an open file).  options are the
+    command line options, as from parse_options() (default_options() if
+    None); of these, whole_file, one_pass, jobs and numpy are used, and
+    the Program keeps them for the formats of its outputs.  The
+    assembly uses the session, or a new AssemblerSession.  Syntax errors
+    don't raise an exception, they are in the diagnostics of the Program
+    returned.  With one_pass, if list_file (an open file) is given, the list
+    file is written to it as the lines assemble, rather than kept in the
+    Program's listing.
+    """
+    if options is None:
+        options = default_options()
+    if session is None:
+        session = AssemblerSession(options)
+    if options.numpy and load_numpy() is None:
+        raise ImportError("The numpy option requires the numpy package")
+
+    if options.one_pass:
+        statements = source_statements(source, options)
+        if list_file is None:
+            listing = []
+            mem_locs = assemble_one_pass(statements, listing.append, session)
+        else:
+            listing = None
+            write_list_header(list_file)
+            mem_locs = assemble_one_pass(
+                statements, lambda s: print(s, file=list_file), session)
+        return Program(session, mem_locs, listing, options)
+
+    code = parse_program(source, options, session)
+    if session.diagnostics:
+        return Program(session, [], [], options)
+
+    # Second pass, now every label is known
+    try:
+        if options.numpy:
+            mem_locs = assemble_columnar(code, session)
+        else:
+            mem_locs = []
+            for c in code:
+                c.assemble(session)
+                mem_locs.extend(c.mem_locs())
+    except SyntaxError as se:
+        session.report(se)
+        return Program(session, [], [], options)
+    listing = [s for s in map(str, code) if s != ""]
+    return Program(session, mem_locs, listing, options)
+
+
+class IncrementalAssembler:
+    """ Keeps a program assembled while its lines are edited (see edit).
+    An edit re-parses only the lines it replaces, and keeps diagnostics up to
+    date.  Addresses, label values and the words of image (address -> word)
+    are brought up to date by update(), which reading image or calling
+    program() does: addresses of the lines after the edits are recomputed
+    only until they are found unchanged (so only if the size of the code
+    changed, and then only up to the next .ORG), and only the lines referring
+    to a label whose value changed are encoded again.  So a burst of edits
+    (keystrokes) moving the code costs one update, done when needed.
+
+    Each line is checked on its own when parsed (in a scratch session);
+    duplicate labels, lines before any .ORG and undefined labels depend on
+    the other lines (but not on addresses), and are checked as those
+    change.  Unlike assemble(), diagnostics have the actual line numbers,
+    and every line with an error is reported (an error doesn't stop the
+    assembly).  Lines with errors put no words in the image.
+
+    Each Entry keeps its line's index (position), so ordering lines costs
+    no search.  An edit moves the lines after it, so they are numbered again
+    when a position is next needed: once per burst of edits.
+    """
+
+    class Entry:
+        """ The state of one line """
+        __slots__ = ('asm', 'error', 'address', 'next_address', 'duplicate',
+                     'undefined', 'reference', 'words', 'live', 'position')
+
+    def __init__(self, source='', session=None):
+        self.session = session or AssemblerSession()  # label values
+        self.scratch = AssemblerSession()   # for checking lines on their own
+        self.lines = []
+        self.entries = []       # an Entry for each line
+        self.numbered = 0       # entries[:numbered] have the right position
+        self.definitions = {}   # label -> Entries defining it, in line order
+        self.references = {}    # label -> set of Entries referring to it
+        self.errors = set()     # Entries with an error (but before_org)
+        self.orgs = set()       # Entries of .ORG lines
+        self.owners = {}        # address -> Entries with a word there
+        self.memory = {}        # address -> word, once updated
+        self.unplaced = None    # (start, end) of lines to place, if any
+        self.relabel = set()    # labels whose value may have changed
+        self.stale = set()      # Entries to encode again
+        self.moved = set()      # addresses whose words changed
+        self.edit(0, 0, source)
+
+    def edit(self, start, end, text):
+        """ Replace lines start to end (counting from 0, end excluded) with
+        the lines of text.  edit(n, n, text) inserts before line n, and
+        edit(start, end, '') deletes.
+        """
+        new_lines = io.StringIO(text).readlines()
+        if new_lines and not new_lines[-1].endswith('\n') and \
+           end < len(self.lines):
+            new_lines[-1] += '\n'  # Don't join the next line onto it
+        if new_lines and start > 0 and \
+           not self.lines[start - 1].endswith('\n'):
+            self.lines[start - 1] += '\n'
+        self.recheck = set()    # Entries whose errors may have changed
+        for e in self.entries[start:end]:
+            self.remove(e)
+        new = [self.parse(line) for line in new_lines]
+        self.lines[start:end] = new_lines
+        self.entries[start:end] = new
+        self.numbered = min(self.numbered, start)
+        self.unplace(start, end, len(new))
+        for e in new:
+            if e.asm and e.asm.label:
+                self.define(e)
+            if e.reference:
+                self.references.setdefault(e.reference, set()).add(e)
+            if e.asm and e.asm.opcode == '.ORG':
+                self.orgs.add(e)
+        self.recheck.update(new)
+        self.stale.update(new)
+        for e in self.recheck:
+            if e.live:
+                self.check(e)
+        self.recheck = None
+
+    def update(self):
+        """ Bring addresses, label values (in session) and image up to date
+        with the edits.
+        """
+        if self.unplaced:
+            self.place(*self.unplaced)
+            self.unplaced = None
+        for label in self.relabel:
+            if label in self.definitions:
+                self.set_symbol(label)
+        self.relabel.clear()
+        for e in self.stale:
+            if e.live:
+                self.encode(e)
+        self.stale.clear()
+        for address in self.moved:
+            self.set_word(address)
+        self.moved.clear()
+
+    @property
+    def image(self):
+        self.update()
+        return self.memory
+
+    @property
+    def source(self):
+        return ''.join(self.lines)
+
+    def parse(self, line):
+        """ Returns a new Entry for the line """
+        e = self.Entry()
+        e.asm = e.error = e.undefined = e.reference = None
+        e.address = e.next_address = -1    # not placed yet
+        e.duplicate = False
+        e.words = ()            # (address, word) pairs put in the image
+        e.live = True
+        e.position = None       # not numbered yet
+        self.scratch.symbols.clear()
+        try:
+            a = AsmLine(line, 0, 0, session=self.scratch)
+        except (SyntaxError, ParseError) as error:
+            e.error = error
+            return e
+        if not (a.label or a.opcode):
+            return e
+        e.asm = a
+        if a.opcode == '.DW':
+            operand = a.operand1
+        elif a.opcode in OpcodeInfo.templates:
+            second_word = OpcodeInfo.templates[a.opcode][2]
+            operand = None if second_word is None else \
+                      (a.operand1, a.operand2, a.operand3)[second_word]
+        else:
+            operand = None
+        if operand and self.scratch.operand_cache.classify(
+                           operand)[0] == 'label':
+            e.reference = operand
+        return e
+
+    def position(self, e):
+        """ The index of the Entry's line.  If it's after the first line
+        edited since the lines were numbered, those from there are numbered
+        again.
+        """
+        if e.position is None or e.position >= self.numbered:
+            for i, moved in enumerate(self.entries[self.numbered:],
+                                      self.numbered):
+                moved.position = i
+            self.numbered = len(self.entries)
+        return e.position
+
+    def remove(self, e):
+        """ Take a replaced line's label, reference and words away """
+        e.live = False
+        if e.asm and e.asm.label:
+            self.undefine(e)
+        if e.reference:
+            self.references[e.reference].discard(e)
+        self.unplace_words(e)
+        self.errors.discard(e)
+        self.orgs.discard(e)
+
+    def unplace(self, start, end, count):
+        """ Lines start to end were replaced by count lines: widen unplaced
+        to cover those.
+        """
+        if self.unplaced is None:
+            low, high = start, start + count
+        else:
+            low, high = self.unplaced
+            if high >= end:
+                high += count - (end - start)
+            elif high > start:
+                high = start + count
+        self.unplaced = (min(low, start), max(high, start + count))
+
+    def place(self, start, end_new):
+        """ Recompute the addresses of the lines from start, until past the
+        lines to place (start to end_new) one is found at the same address.
+        """
+        entries = self.entries
+        address = entries[start - 1].next_address if start > 0 else None
+        for i in range(start, len(entries)):
+            e = entries[i]
+            if e.address == address and i >= end_new:
+                break               # and so is everything after it
+            e.address = address
+            if e.asm:
+                e.asm.mem_address = address
+                address = e.asm.next_mem_address()
+                label = e.asm.label
+                if label and label in self.definitions and \
+                   self.definitions[label][0] is e:
+                    self.set_symbol(label)
+            e.next_address = address
+            self.stale.add(e)       # its words move
+
+    def define(self, e):
+        label = e.asm.label
+        definers = self.definitions.setdefault(label, [])
+        definers.append(e)
+        if len(definers) > 1:       # Duplicates are rare: sort by position
+            definers.sort(key=self.position)
+            for d in definers:
+                duplicate = d is not definers[0]
+                if d.duplicate != duplicate:
+                    d.duplicate = duplicate
+                    self.recheck.add(d)
+                    self.stale.add(d)
+        else:                       # Lines referring to it are now defined
+            self.recheck.update(self.references.get(label, ()))
+            self.stale.update(self.references.get(label, ()))
+        self.relabel.add(label)
+
+    def undefine(self, e):
+        label = e.asm.label
+        definers = self.definitions[label]
+        definers.remove(e)
+        if not definers:
+            del self.definitions[label]
+            self.session.symbols.table.pop(label, None)
+            self.recheck.update(self.references.get(label, ()))
+            self.stale.update(self.references.get(label, ()))
+        elif definers[0].duplicate:
+            definers[0].duplicate = False
+            self.recheck.add(definers[0])
+            self.stale.add(definers[0])
+            self.relabel.add(label)
+
+    def set_symbol(self, label):
+        """ Give the label the value from the first line defining it, and
+        encode again the lines referring to it if that changed it.
+        """
+        owner = self.definitions[label][0].asm
+        if owner.opcode == '.EQU':
+            value = self.session.operand_cache.classify(owner.operand1)[1]
+        else:
+            value = owner.mem_address
+        table = self.session.symbols.table
+        if label not in table or table[label] != value:
+            table[label] = value
+            self.stale.update(self.references.get(label, ()))
+
+    def check(self, e):
+        """ Find whether the line has an error, but for being before_org """
+        e.undefined = None
+        if e.reference and not (e.error or e.duplicate) and \
+           e.reference not in self.definitions:
+            e.undefined = e.reference
+        if e.error or e.duplicate or e.undefined:
+            self.errors.add(e)
+        else:
+            self.errors.discard(e)
+
+    def encode(self, e):
+        """ Assemble the line's words again, and put them in the image """
+        self.unplace_words(e)
+        a = e.asm
+        if a and e not in self.errors and e.address is not None:
+            a.word1 = a.word2 = None
+            a.assemble(self.session)
+            e.words = tuple(a.mem_locs())
+            for address, word in e.words:
+                self.owners.setdefault(address, []).append(e)
+                self.moved.add(address)
+
+    def before_org(self):
+        """ The set of lines with a label or opcode before the first .ORG """
+        first = min(map(self.position, self.orgs), default=len(self.entries))
+        return set(e for e in self.entries[:first]
+                   if e.asm and e.asm.opcode != '.EQU')
+
+    def unplace_words(self, e):
+        words, e.words = e.words, ()
+        for address, word in words:
+            self.owners[address].remove(e)
+            self.moved.add(address)
+
+    def set_word(self, address):
+        """ The word at an address is from the last line putting one there """
+        owners = self.owners[address]
+        if not owners:
+            del self.owners[address]
+            self.memory.pop(address, None)
+            return
+        if len(owners) > 1:
+            owners.sort(key=self.position)
+        self.memory[address] = dict(owners[-1].words)[address]
+
+    @property
+    def diagnostics(self):
+        """ The SyntaxError (and ParseError) of each line with an error, in
+        line order.  Takes time proportional to the number of errors, of
+        .ORG lines and of lines before the first .ORG; after an edit, also
+        to the lines after it, which are numbered again.
+        """
+        diagnostics = []
+        before_org = self.before_org()
+        for e in sorted(self.errors | before_org, key=self.position):
+            line_number = e.position + 1
+            if e.error:
+                error = type(e.error)(line_number, e.error.reason_text)
+            elif e.duplicate:
+                error = SyntaxError(line_number, "Duplicate label (" +
+                                    e.asm.label + ").  Label has already " +
+                                    "been declared on a previous line.")
+            elif e in before_org:
+                error = SyntaxError(line_number, "You must use .ORG to " +
+                                    "initialize a memory section before " +
+                                    "any line with a label or opcode")
+            else:
+                error = SyntaxError(line_number, "The label " + e.undefined +
+                                    " has not been defined anywhere.")
+            diagnostics.append(error)
+        return diagnostics
+
+    def program(self):
+        """ A Program of the current state, to write the outputs.  Takes
+        time proportional to the whole program.
+        """
+        self.update()
+        code = [e.asm for e in self.entries if e.asm]
+        mem_locs = [loc for a in code for loc in a.mem_locs()]
+        listing = [s for s in map(str, code) if s != ""]
+        self.session.diagnostics = self.diagnostics
+        return Program(self.session, mem_locs, listing)
+
+
+class LanguageServer:
+    """ A Language Server Protocol server, for editors.  Messages are JSON-RPC,
+    each preceded by a Content-Length header, read from input and written to
+    output (binary streams).  Each open document is kept assembled by an
+    IncrementalAssembler, which every change edits straight away.  The
+    diagnostics of a document are published once no message has come for
+    debounce seconds, so that a burst of keystrokes is validated (in
+    increments) but published once.  Also answers go to definition and hover
+    for labels.  Positions count characters, which for RISC240 source (ASCII)
+    are the UTF-16 code units of the protocol.  A message that can't be
+    read or handled gets an error response (if it's a request), or is
+    logged to stderr and dropped; the server carries on.
+    """
+
+    debounce = 0.05
+
+    def __init__(self, input, output):
+        self.input = input
+        self.output = output
+        import queue
+        self.messages = queue.Queue()
+        self.documents = {}     # uri -> IncrementalAssembler
+        self.pending = set()    # uris with diagnostics to publish
+        self.shutdown = False
+        self.handlers = {'initialize': self.initialize,
+                         'shutdown': self.request_shutdown,
+                         'textDocument/didOpen': self.did_open,
+                         'textDocument/didChange': self.did_change,
+                         'textDocument/didClose': self.did_close,
+                         'textDocument/definition': self.definition,
+                         'textDocument/hover': self.hover}
+
+    def run(self):
+        """ Serve until the exit notification (or the end of input).
+        Returns the exit code: 0 if there was a shutdown request first.
+        """
+        import queue, threading
+        reader = threading.Thread(target=self.read_messages, daemon=True)
+        reader.start()
+        while True:
+            try:
+                message = self.messages.get(
+                              timeout=self.debounce if self.pending else None)
+            except queue.Empty:
+                self.publish_pending()
+                continue
+            if isinstance(message, ValueError):
+                self.send({'id': None,
+                           'error': {'code': -32700,
+                                     'message': 'Parse error: ' +
+                                                str(message)}})
+                continue
+            if message is None or message.get('method') == 'exit':
+                self.publish_pending()
+                return 0 if self.shutdown else 1
+            self.handle(message)
+
+    def read_messages(self):
+        """ Queue each message read (on a thread of its own) up to exit, or
+        None at the end of input.  A message which isn't a JSON object is
+        queued as the ValueError it gives.
+        """
+        import json
+        while True:
+            length = None
+            while True:
+                header = self.input.readline()
+                if not header:
+                    self.messages.put(None)
+                    return
+                header = header.strip()
+                if not header:
+                    break
+                name, _, value = header.partition(b':')
+                if name.strip().lower() == b'content-length':
+                    length = value
+            if length is None:
+                continue
+            try:
+                length = int(length)
+                if length < 0:
+                    raise ValueError('Content-Length ' + str(length))
+                message = json.loads(self.input.read(length))
+                if not isinstance(message, dict):
+                    raise ValueError('not a JSON object')
+            except ValueError as e:
+                self.messages.put(e)
+                continue
+            self.messages.put(message)
+            if message.get('method') == 'exit':
+                return          # Read no more
+
+    def send(self, message):
+        import json
+        message['jsonrpc'] = '2.0'
+        body = json.dumps(message).encode()
+        self.output.write(b'Content-Length: ' + str(len(body)).encode() +
+                          b'\r\n\r\n' + body)
+        self.output.flush()
+
+    def handle(self, message):
+        """ Handle a message.  A handler given params it can't use raises
+        LookupError, TypeError or AttributeError: the response to a request
+        is then an invalid params error, and to any other exception an
+        internal error.
+        """
+        method = message.get('method')
+        handler = self.handlers.get(method)
+        if 'id' not in message:         # A notification
+            if handler:
+                try:
+                    handler(message.get('params'))
+                except Exception as e:
+                    print('as240 --lsp: dropped ' + str(method) + ': ' +
+                          type(e).__name__ + ': ' + str(e), file=sys.stderr)
+            return
+        if handler is None:
+            self.send({'id': message['id'],
+                       'error': {'code': -32601,
+                                 'message': 'Method not found: ' +
+                                            str(method)}})
+            return
+        try:
+            result = handler(message.get('params'))
+        except (LookupError, TypeError, AttributeError) as e:
+            error = {'code': -32602, 'message': 'Invalid params: ' +
+                                                type(e).__name__ + ': ' +
+                                                str(e)}
+        except Exception as e:
+            error = {'code': -32603, 'message': 'Internal error: ' +
+                                                type(e).__name__ + ': ' +
+                                                str(e)}
+        else:
+            self.send({'id': message['id'], 'result': result})
+            return
+        self.send({'id': message['id'], 'error': error})
+
+    def initialize(self, params):
+        return {'capabilities': {'textDocumentSync': 2,  # incremental
+                                 'definitionProvider': True,
+                                 'hoverProvider': True},
+                'serverInfo': {'name': 'as240', 'version': VERSION}}
+
+    def request_shutdown(self, params):
+        self.shutdown = True
+        return None
+
+    def did_open(self, params):
+        document = params['textDocument']
+        self.documents[document['uri']] = IncrementalAssembler(
+                                              document['text'])
+        self.pending.add(document['uri'])
+
+    def did_change(self, params):
+        uri = params['textDocument']['uri']
+        engine = self.documents[uri]
+        for change in params['contentChanges']:
+            if 'range' not in change:
+                engine.edit(0, len(engine.lines), change['text'])
+                continue
+            start = change['range']['start']
+            end = change['range']['end']
+            lines = engine.lines
+            first = lines[start['line']] if start['line'] < len(lines) else ''
+            last = lines[end['line']] if end['line'] < len(lines) else ''
+            engine.edit(start['line'], min(end['line'] + 1, len(lines)),
+                        first[:start['character']] + change['text'] +
+                        last[end['character']:])
+        self.pending.add(uri)
+
+    def did_close(self, params):
+        uri = params['textDocument']['uri']
+        del self.documents[uri]
+        self.pending.discard(uri)
+        self.send({'method': 'textDocument/publishDiagnostics',
+                   'params': {'uri': uri, 'diagnostics': []}})
+
+    def publish_pending(self):
+        for uri in sorted(self.pending):
+            engine = self.documents[uri]
+            diagnostics = []
+            for error in engine.diagnostics:
+                line = error.line_number - 1
+                diagnostics.append({
+                    'range': {'start': {'line': line, 'character': 0},
+                              'end': {'line': line, 'character':
+                                      len(engine.lines[line].rstrip('\n'))}},
+                    'severity': 1,
+                    'source': 'as240',
+                    'message': ' '.join(str(error.reason_text).split())})
+            self.send({'method': 'textDocument/publishDiagnostics',
+                       'params': {'uri': uri, 'diagnostics': diagnostics}})
+        self.pending.clear()
+
+    def label_at(self, params):
+        """ Returns (engine, label, range) for the label at the position,
+        or None if there isn't a label (defined or not) there.
+        """
+        engine = self.documents.get(params['textDocument']['uri'])
+        position = params['position']
+        if not engine or position['line'] >= len(engine.lines):
+            return None
+        line = engine.lines[position['line']]
+        for word in re.finditer(r'\w+', line.split(';', 1)[0]):
+            if word.start() <= position['character'] <= word.end():
+                label = word.group().upper()
+                if AsmLine.re_vallabel.search(label):
+                    return engine, label, {
+                        'start': {'line': position['line'],
+                                  'character': word.start()},
+                        'end': {'line': position['line'],
+                                'character': word.end()}}
+        return None
+
+    def definition(self, params):
+        found = self.label_at(params)
+        if not found or found[1] not in found[0].definitions:
+            return None
+        engine, label, word_range = found
+        line = engine.position(engine.definitions[label][0])
+        return {'uri': params['textDocument']['uri'],
+                'range': {'start': {'line': line, 'character': 0},
+                          'end': {'line': line, 'character': len(label)}}}
+
+    def hover(self, params):
+        found = self.label_at(params)
+        if not found or found[1] not in found[0].definitions:
+            return None
+        engine, label, word_range = found
+        engine.update()
+        owner = engine.definitions[label][0].asm
+        value = engine.session.symbols.table[label]
+        if owner.opcode == '.EQU':
+            text = label + ' .EQU ${:04X}'.format(value)
+        elif value is None:
+            text = label + ' (no address: before any .ORG)'
+        else:
+            text = label + ' at address ${:04X}'.format(value)
+        return {'contents': {'kind': 'plaintext', 'value': text},
+                'range': word_range}
+
+
 # Command line processing
+# (The as240 launcher, or python -m as240 with as240.py's directory on the
+# path, starts faster than running as240.py: Python caches the compiled
+# module, but not a script.)
 # -h, --help	Provide short help text and usage information
 # -m <filename>	Use the specified filename for the memory.hex file
 # -l <filename>	Use the specified filename for the .list file
 # -s [<filename>]	Output the symbol list as <basename>.sym or
 #    <filename> if specified
 # -	Send .list output to stdout (for piping into sim240) rather than a file.
+# --binfile <filename>	Also output the memory image in binary, for tools to
+#    read (or mmap) without parsing: 16-bit little-endian words, word n (at
+#    byte address 2n) at offset 2n, all $8000 of them.
+# --binspan	Make the --binfile only the span from the first word to the
+#    last, after a 12 byte header: 'R240', then the word address of the
+#    first word and the number of words (32-bit little-endian).
+# --ihexfile <filename>	Also output the memory image as Intel HEX: the bytes
+#    of --binfile, at their byte addresses, in records of up to 127 words.
+#    Memory without words is left out.
+# --wholefile	Read the whole ASM file at once, and tokenize it in one pass
+#    over the buffer (each distinct line once), rather than line by line.
+#    Output is identical.
+# --onepass	Assemble in a single pass, patching forward references when
+#    their labels are defined.  The list file is written as lines assemble
+#    (unless with --cache), to a temporary file copied to the list file if
+#    there are no errors.
+# -j <n>, --jobs <n>	Parse and validate the ASM file in chunks, on n
+#    processes.  Output is identical.  With --batch or --check, take n files
+#    at once.
+# --batch	Assemble many ASM files: the arguments are file names, glob
+#    patterns (like 'hw3/*.asm') or @manifest files listing one file per
+#    line.  Each file's outputs go in a directory of their own, under
+#    --outdir.  A summary line is printed for each file, and the exit code is
+#    the number of files which didn't assemble (at most 255).
+# --outdir <dir>	Where --batch puts the output directories (default .)
+# --if-changed	Write each output file only if its content changed (so that
+#    tools watching its modification time aren't set off), replacing it
+#    atomically.  If the assembly fails, the outputs are left as they were.
+#    Without it, the outputs are emptied before assembling.
+# --check	Only check ASM files for errors (syntax errors and undefined
+#    labels), without assembling them or writing any file.  The files are
+#    given as for --batch, and a line is printed for each, with its first
+#    error.  The exit code is the number of files with errors (at most 255).
+# --server <socket>	Run an assembler server on the Unix socket, which stays
+#    running (with everything compiled) to assemble for clients.
+# --connect <socket>	Have the server on the socket do the assembly.  Files,
+#    messages and exit code are just as without it.  If the server can't be
+#    reached, assemble here.
+# --cache <dir>	Keep assembly results in the directory, and reuse them when
+#    the same source is assembled again (by any process).
+# --cache-size <MB>	Delete the least recently used results once the cache
+#    holds more than this (default 100)
+# --cache-stats	Print the size and hit rate of the --cache directory and quit.
+# --lsp	Run a Language Server Protocol server on stdin and stdout, giving
+#    editors diagnostics as the code is typed, go to definition of labels,
+#    and hovers showing their values.
+# --sparse	Write the memory file in the sparse format $readmemh reads: each
+#    run of words after a @<word address> record, leaving out the zeros
+#    between them (and below the first .ORG).
+# --numpy	Encode the whole program at once with NumPy (if installed),
+#    rather than line by line.  Output is identical.
 # -version	Print the version of as240 and quit.
 # If syntax errors are encountered, up to 5 will be printed on SYSERR.  The
 #    the assembler will be terminated and the number of syntax errors set as
 #    the exit code
 
+MAX_SYNTAX_ERRORS = 5
+
+VERSION = "3.0"  # Perl version went to 1.5 or so
+                 # P18240 version went to 2.11
+
 def parse_command_line():
     """Deep and thorough parsing of command line options.
 
@@ -1126,11 +2474,14 @@ def parse_command_line():
         asm_data : A string with the entire contents of the assembly file
         file_list, file_mem, file_mif, file_sym : file objects for the output files
     """
+    return open_files(*parse_options())
+
+def option_parser():
+    """ Returns the OptionParser for the command line """
+    from optparse import OptionParser
     usage = "usage: %prog [options] ASM_FILE"
-    program_version = "3.0"  # Perl version went to 1.5 or so
-                             # P18240 version went to 2.11
 
-    parser = OptionParser(usage=usage, version="%prog " + program_version)
+    parser = OptionParser(usage=usage, version="%prog " + VERSION)
 
     parser.add_option("-m", "--mfile",
                       dest="mfile",
@@ -1159,10 +2510,146 @@ def parse_command_line():
                       metavar = 'MIF_FILE',
                       help = 'Output memory in mif format to MIF_FILE',
                       default='memory.mif')
+    parser.add_option('--binfile',
+                      dest='bin_file',
+                      metavar='BIN_FILE',
+                      help='Also output memory as packed 16-bit ' +
+                           'little-endian words to BIN_FILE',
+                      default=None)
+    parser.add_option('--binspan',
+                      dest='bin_span',
+                      action='store_true',
+                      help='Only put the span of memory holding words in ' +
+                           'BIN_FILE, after a header',
+                      default=False)
+    parser.add_option('--ihexfile',
+                      dest='ihex_file',
+                      metavar='IHEX_FILE',
+                      help='Also output memory in Intel HEX format to ' +
+                           'IHEX_FILE',
+                      default=None)
+    parser.add_option('--wholefile',
+                      dest='whole_file',
+                      action='store_true',
+                      help='Read the whole ASM_FILE at once and tokenize ' +
+                           'it in one pass, rather than line by line',
+                      default=False)
+    parser.add_option('--onepass',
+                      dest='one_pass',
+                      action='store_true',
+                      help='Assemble in a single pass, patching forward ' +
+                           'references to labels when they are defined',
+                      default=False)
+    parser.add_option('-j', '--jobs',
+                      dest='jobs',
+                      type='int',
+                      metavar='JOBS',
+                      help='Parse and validate the ASM_FILE on JOBS ' +
+                           'processes (for very large files)',
+                      default=1)
+    parser.add_option('--numpy',
+                      dest='numpy',
+                      action='store_true',
+                      help='Encode the program with vectorized NumPy ' +
+                           'operations (requires numpy)',
+                      default=False)
+    parser.add_option('--sparse',
+                      dest='sparse',
+                      action='store_true',
+                      help='Write MEM_FILE with @address records before ' +
+                           'runs of words, rather than zeros between them',
+                      default=False)
+    parser.add_option('--batch',
+                      dest='batch',
+                      action='store_true',
+                      help='Assemble many ASM files (names, glob patterns ' +
+                           'or @manifest files), each into a directory of ' +
+                           'its own',
+                      default=False)
+    parser.add_option('--outdir',
+                      dest='outdir',
+                      metavar='DIR',
+                      help='Put the --batch output directories in DIR',
+                      default='.')
+    parser.add_option('--if-changed',
+                      dest='if_changed',
+                      action='store_true',
+                      help='Only replace output files whose content ' +
+                           'changes, and none if the assembly fails',
+                      default=False)
+    parser.add_option('--check',
+                      dest='check',
+                      action='store_true',
+                      help='Only check many ASM files (as for --batch) ' +
+                           'for errors, writing no files',
+                      default=False)
+    parser.add_option('--server',
+                      dest='server',
+                      metavar='SOCKET',
+                      help='Run an assembler server on the Unix SOCKET',
+                      default=None)
+    parser.add_option('--connect',
+                      dest='connect',
+                      metavar='SOCKET',
+                      help='Assemble on the server at the Unix SOCKET',
+                      default=None)
+    parser.add_option('--cache',
+                      dest='cache',
+                      metavar='DIR',
+                      help='Reuse assembly results kept in DIR',
+                      default=None)
+    parser.add_option('--cache-size',
+                      dest='cache_size',
+                      type='int',
+                      metavar='MB',
+                      help='Limit the --cache directory to MB megabytes',
+                      default=100)
+    parser.add_option('--cache-stats',
+                      dest='cache_stats',
+                      action='store_true',
+                      help='Print statistics of the --cache directory',
+                      default=False)
+    parser.add_option('--lsp',
+                      dest='lsp',
+                      action='store_true',
+                      help='Run a language server for editors, on stdin ' +
+                           'and stdout',
+                      default=False)
+    return parser
+
+def default_options():
+    """ The options when none are given on the command line """
+    return option_parser().get_default_values()
 
+def parse_options():
+    """ Parse the command line.
+    Returns:
+        parser : the OptionParser, for reporting errors
+        options : the options, plus the afile, basefile and lfile names
+    """
+    parser = option_parser()
     (options, args) = parser.parse_args()
-    if len(args) > 1:
+    many_files = options.batch or options.check
+    if len(args) > 1 and not many_files:
         parser.error("incorrect number of arguments")
+    if options.numpy and load_numpy() is None:
+        parser.error("--numpy requires the numpy package")
+    if options.one_pass and (options.numpy or
+                             (options.jobs > 1 and not many_files)):
+        parser.error("--onepass can't be used with --numpy or --jobs")
+    if options.server or options.lsp:
+        return parser, options
+    if options.cache_stats:
+        if not options.cache:
+            parser.error("--cache-stats requires --cache")
+        return parser, options
+    if many_files:
+        if options.output_to_stdout:
+            parser.error("-o can't be used with --batch or --check")
+        options.files = batch_files(args)
+        if not options.files:
+            parser.error("no ASM files to assemble")
+        return parser, options
     if (len(args) == 0) and not (options.output_to_stdout):
         parser.error("incorrect number of arguments")
 
@@ -1176,6 +2663,84 @@ def parse_command_line():
     if not options.lfile :
         options.lfile = options.basefile + ".list"
 
+    return parser, options
+
+class AtomicOutputFile:
+    """ An output file for --if-changed.  What is written is kept in memory
+    until close(), which writes it to a temporary file in the same directory
+    and renames that over the file, unless the file holds that already (so
+    its modification time only changes with its content).  A file which is
+    never closed, because the assembly failed, is left as it was.  Used as
+    a context manager, it's closed only if no exception was raised.  mode
+    is 'w', or 'wb' for bytes.
+    """
+
+    def __init__(self, filename, mode='w'):
+        self.filename = filename
+        self.mode = mode
+        self.parts = []
+
+    def write(self, text):
+        self.parts.append(text)
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+    def close(self):
+        """ Put the text in the file if it changed.  Returns whether it did """
+        import filecmp
+        if self.parts is None:
+            return False        # Closed already
+        prefix = os.path.join(os.path.dirname(self.filename),
+                              '.' + os.path.basename(self.filename) + '.')
+        while True:
+            # Made with the mode open() would give the file (so the umask
+            # applies, without changing it to read it)
+            temp_path = prefix + os.urandom(6).hex() + '.tmp'
+            try:
+                fd = os.open(temp_path,
+                             os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+                break
+            except FileExistsError:
+                continue
+        try:
+            with os.fdopen(fd, self.mode) as f:
+                f.write((b'' if 'b' in self.mode else '').join(self.parts))
+            self.parts = None
+            if os.path.isfile(self.filename) and \
+               filecmp.cmp(temp_path, self.filename, shallow=False):
+                os.unlink(temp_path)
+                return False
+            if os.path.exists(self.filename):
+                os.chmod(temp_path, os.stat(self.filename).st_mode & 0o7777)
+            os.replace(temp_path, self.filename)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+        return True
+
+def open_output(filename, options, mode='w'):
+    """ Open an output file for writing (mode 'w' or 'wb'): an
+    AtomicOutputFile if the options have if_changed.
+    """
+    if options.if_changed:
+        return AtomicOutputFile(filename, mode)
+    return open(filename, mode)
+
+def open_files(parser, options):
+    """ Open the ASM file, and the output files named by the options.
+    Returns:
+        file_asm, file_list, file_mem, file_sym, file_mif : file objects
+    """
     try:
         file_asm = open(options.afile, 'r')
     except IOError:
@@ -1184,48 +2749,198 @@ def parse_command_line():
     if (options.output_to_stdout):
         file_list = sys.stdout
         if options.sfile:
-            file_sym = open(options.sfile, 'w')
+            file_sym = open_output(options.sfile, options)
         else:
             file_sym = open('/dev/null', 'w')
         if options.mfile:
-            file_mem = open(options.mfile, 'w')
+            file_mem = open_output(options.mfile, options)
         else:
             file_mem = open('/dev/null', 'w')
         if options.mif_file:
-            file_mif = open(options.mif_file, 'w')
+            file_mif = open_output(options.mif_file, options)
         else:
             file_mif = open('/dev/null', 'w')
     else:
-        file_list = open(options.lfile, 'w')
-        file_mem = open(options.mfile, 'w')
-        file_mif = open(options.mif_file, 'w')
+        file_list = open_output(options.lfile, options)
+        file_mem = open_output(options.mfile, options)
+        file_mif = open_output(options.mif_file, options)
         if options.sfile :
-            file_sym = open(options.sfile, 'w')
+            file_sym = open_output(options.sfile, options)
         else:
             file_sym = open('/dev/null', 'w')
 
     return [file_asm, file_list, file_mem, file_sym, file_mif]
 
 
-def create_mem_file(mem_file, locs):
+class MemoryImage:
+    """ The lines of memory.hex, as an array of words (array('H'), unless a
+    word is out of range).  Sorted by address, each word goes on line
+    max(the line after the last word, ceil(address / 2)), the lines between
+    being zeros: so with even addresses, the index of a word is its word
+    address.  (An odd or repeated address pushes the words after it down.)
+    With word_addresses, as for binary() and intel_hex(), word n is instead
+    the last of the words given address 2n or 2n+1, so the index of every
+    word is its word address (addr >> 1).
+    runs are the [start, end) indexes of the runs of lines holding words.
+    """
+
+    def __init__(self, locs, word_addresses=False):
+        if word_addresses:
+            # The last word given each word address, at the even address
+            locs = dict(((addr >> 1) << 1, val) for addr, val in locs).items()
+        locs = sorted(locs, key=itemgetter(0))
+        if all(val <= 0xFFFF for addr, val in locs):
+            self.words = array('H')
+        else:
+            self.words = array('L')
+        self.runs = []
+        words = self.words
+        for addr, val in locs:
+            gap = ((addr + 1) >> 1) - len(words)
+            if gap > 0:
+                words.frombytes(bytes(gap * words.itemsize))
+            if gap > 0 or not self.runs:
+                self.runs.append([len(words), len(words) + 1])
+            else:
+                self.runs[-1][1] += 1
+            words.append(val)
+
+    def hex_text(self, start=0, end=None):
+        """ The text of memory.hex (or of its lines start to end), made at
+        once: a line per word, of (at least) four hex digits.
+        """
+        words = self.words[start:end]
+        if not words:
+            return ''
+        if words.typecode != 'H':
+            return ''.join(map('{:04X}\n'.format, words))
+        if sys.byteorder == 'little':
+            words.byteswap()
+        return words.tobytes().hex('\n', 2).upper() + '\n'
+
+    def sparse_text(self):
+        """ The text of a sparse memory.hex, for $readmemh: each run of
+        words, after a @ record of the word address it starts at.  It loads
+        the same words as hex_text(), leaving the memory between the runs
+        as it was, rather than zeroing it.
+        """
+        return ''.join('@{:04X}\n'.format(start) + self.hex_text(start, end)
+                       for start, end in self.runs)
+
+    def binary(self, span=False):
+        """ The words packed as 16-bit little-endian numbers, word n at byte
+        2n (so at its address, with word_addresses): all of memory ($8000
+        words, or more if there are words past byte $FFFF).  With span, only
+        the words from the first run to the end of the last, after a 12 byte
+        header: b'R240', the word address of the first word and the number
+        of words, as 32-bit little-endian numbers.  A word above $FFFF is cut
+        to 16 bits.
+        """
+        if span:
+            start = self.runs[0][0] if self.runs else 0
+            data = self.packed(start)
+            return (b'R240' + start.to_bytes(4, 'little') +
+                    (len(data) // 2).to_bytes(4, 'little') + data)
+        data = self.packed()
+        return data + bytes(max(0, 0x10000 - len(data)))
+
+    def packed(self, start=0, end=None):
+        """ Words start to end as 16-bit little-endian numbers (bytes) """
+        words = self.words[start:end]
+        if words.typecode != 'H':
+            words = array('H', (word & 0xFFFF for word in words))
+        if sys.byteorder == 'big':
+            words.byteswap()
+        return words.tobytes()
+
+    # The most data bytes in an Intel HEX record (which can hold 255) that
+    # keep words whole
+    ihex_record_size = 254
+
+    def intel_hex(self):
+        """ The text of an Intel HEX file of the words: the bytes of
+        binary(), each run of words in as few data records as fit, and
+        nothing for the space between runs.  Addresses past $FFFF come
+        after an extended linear address record.
+        """
+        records = []
+        upper = 0               # of the address, for the records after
+        for start, end in self.runs:
+            data = self.packed(start, end)
+            address = 2 * start
+            offset = 0
+            while offset < len(data):
+                if address >> 16 != upper:
+                    upper = address >> 16
+                    records.append(intel_hex_record(
+                                       0, 4, upper.to_bytes(2, 'big')))
+                size = min(self.ihex_record_size, len(data) - offset,
+                           0x10000 - (address & 0xFFFF))
+                records.append(intel_hex_record(
+                                   address & 0xFFFF, 0,
+                                   data[offset:offset + size]))
+                address += size
+                offset += size
+        records.append(intel_hex_record(0, 1, b''))     # End of file
+        return ''.join(records)
+
+def intel_hex_record(address, record_type, data):
+    """ An Intel HEX record (a line): the byte count, 16-bit address, type,
+    data and checksum, in hex after a colon.
+    """
+    record = bytes((len(data), address >> 8, address & 0xFF,
+                    record_type)) + data
+    record += bytes([-sum(record) & 0xFF])      # Checksum
+    return ':' + record.hex().upper() + '\n'
+
+def create_mem_file(mem_file, locs, sparse=False):
     """ Create the memory file (traditionally memory.hex) from a list of
-        address, data tuples.  Note that the locs are word values."""
-    sorter = lambda x : x[0]
-    locs = sorted(locs, key=sorter)
-    curr_addr = 0
-    for loc in locs:
-        addr, val = loc
-        while(curr_addr < addr):
-            print("0000", file=mem_file)
-            curr_addr += 2
-        print('{:04X}'.format(val), file=mem_file)
-        curr_addr += 2
+        address, data tuples.  Note that the locs are word values.
+        If sparse, only the runs of words are written, see sparse_text."""
+    image = MemoryImage(locs)
+    mem_file.write(image.sparse_text() if sparse else image.hex_text())
+
+def mif_ranges(locs):
+    """ Run-length code the MIF content of (addr, data) tuples, as a list
+    of [first, last, data] address ranges.  MIF addresses are the byte
+    addresses, so words are (mostly) two addresses apart, the odd address
+    between them being left out, as it always was.  The runs of two or more
+    addresses not given a word are filled with zero, to the end of memory.
+    A run of words of the same data (a single address apart, or adjacent)
+    becomes one range, which gives its data to the odd addresses in the
+    range too; only even addresses are read as words, so that's harmless.
+    If an address is given more than one word, the last is kept.
+    """
+    ranges = []
+    def add(first, last, data):
+        if ranges and ranges[-1][2] == data and first - ranges[-1][1] <= 2:
+            ranges[-1][1] = last
+        else:
+            ranges.append([first, last, data])
+    end = -1                    # the last address given a word
+    for addr, val in sorted(dict(locs).items()):
+        if addr - end > 2:
+            add(end + 1, addr - 1, 0)
+        add(addr, addr, val)
+        end = addr
+    if 0xFFFF - end >= 2:
+        add(end + 1, 0xFFFF, 0)
+    return ranges
+
+def create_bin_file(bin_file, locs, span=False):
+    """ Create the binary memory image (a file open for binary writing)
+        from a list of address, data tuples, see MemoryImage.binary.  """
+    bin_file.write(MemoryImage(locs, word_addresses=True).binary(span))
+
+def create_ihex_file(ihex_file, locs):
+    """ Create the Intel HEX file from a list of address, data tuples,
+        see MemoryImage.intel_hex.  """
+    ihex_file.write(MemoryImage(locs, word_addresses=True).intel_hex())
 
 def create_mif_file(mif_file, locs):
     """ Create the memory file for synthesis from a list of
-        address, data tuples.  """
-    sorter = lambda x : x[0]
-    locs = sorted(locs, key=sorter)
+        address, data tuples.  Runs of the same data are written as
+        address ranges, see mif_ranges.  """
 
     #NOTE: Changed DEPTH to be full range of 16-bit address space (ekusuma)
     #   May need to revert this when changing back to Cyclone IV E
@@ -1241,63 +2956,608 @@ def create_mif_file(mif_file, locs):
                 CONTENT
                 BEGIN
              """
-    start_template = '[0000 .. {:04X}] : 0000; % Fill starting range with zero'
-    print(header, file=mif_file)
-    for addr, val in locs:
-        print('{:04X} : {:04X};'.format(addr, val), file=mif_file)
-    print('END;', file=mif_file)
+    lines = [header]
+    for first, last, data in mif_ranges(locs):
+        if first == last:
+            lines.append('{:04X} : {:04X};'.format(first, data))
+        else:
+            lines.append('[{:04X} .. {:04X}] : {:04X};'.format(first, last,
+                                                               data))
+    lines.append('END;\n')
+    mif_file.write('\n'.join(lines))
+
+def batch_files(args):
+    """ Expand the arguments of --batch into a list of ASM file names.  An
+    argument is a file name, a glob pattern, or @ and the name of a manifest
+    file, listing one file name (or pattern) per line.  Blank lines and
+    lines starting with # are skipped, and names are relative to the
+    manifest's directory.  Each file is listed once, in the order found.
+    """
+    import glob
+    filenames = []
+    for arg in args:
+        if arg.startswith('@'):
+            with open(arg[1:]) as manifest:
+                names = [line.strip() for line in manifest]
+            directory = os.path.dirname(arg[1:])
+            patterns = [os.path.join(directory, name) for name in names
+                        if name and not name.startswith('#')]
+        else:
+            patterns = [arg]
+        for pattern in patterns:
+            if glob.has_magic(pattern):
+                filenames.extend(sorted(glob.glob(pattern, recursive=True)))
+            else:
+                filenames.append(pattern)   # a missing file fails, later
+    return list(OrderedDict.fromkeys(filenames))
 
-def main():
+def batch_output_dirs(filenames, outdir):
+    """ Name an output directory under outdir for each file: the file's
+    basename (without extension), with a -2, -3, ... suffix if files in
+    different directories share a basename.
+    """
+    dirs = []
+    used = set()
+    for filename in filenames:
+        name = os.path.splitext(os.path.basename(filename))[0]
+        candidate = name
+        suffix = 1
+        while candidate in used:
+            suffix += 1
+            candidate = name + '-' + str(suffix)
+        used.add(candidate)
+        dirs.append(os.path.join(outdir, candidate))
+    return dirs
+
+def assemble_file(job):
+    """ Worker for assemble_batch: assemble one ASM file, in a session of
+    its own.  job is (asm_filename, out_dir, options).  If it assembles, the
+    list, symbol, memory and MIF files are written to out_dir; otherwise the
+    syntax errors are written to a .err file there.  Either way, the files
+    of the other outcome (left from an earlier run) are removed from
+    out_dir.  Never raises; returns
+    (status, error_count, seconds, message), where status is 'ok', 'error'
+    (syntax errors) or 'failed' (the file couldn't be read or written).
+    """
+    asm_filename, out_dir, options = job
+    start = time.perf_counter()
+    base = os.path.splitext(os.path.basename(asm_filename))[0]
+    try:
+        with open(asm_filename) as file_asm:
+            program = assemble(file_asm, options)
+        os.makedirs(out_dir, exist_ok=True)
+        outputs = [(base + '.list', program.write_list, 'w'),
+                   (base + '.sym', program.write_symbols, 'w'),
+                   (os.path.basename(options.mfile), program.write_mem, 'w'),
+                   (os.path.basename(options.mif_file), program.write_mif,
+                    'w')]
+        if options.bin_file:
+            outputs.append((os.path.basename(options.bin_file),
+                            program.write_bin, 'wb'))
+        if options.ihex_file:
+            outputs.append((os.path.basename(options.ihex_file),
+                            program.write_ihex, 'w'))
+        if program.ok:
+            status, message = 'ok', ''
+            for name, write, mode in outputs:
+                with open_output(os.path.join(out_dir, name), options,
+                                 mode) as f:
+                    write(f)
+            stale = [base + '.err']
+        else:
+            status, message = 'error', str(program.diagnostics[0])
+            with open(os.path.join(out_dir, base + '.err'), 'w') as f:
+                for error in program.diagnostics:
+                    print(error, file=f)
+            stale = [name for name, write, mode in outputs]
+        for name in stale:      # From an earlier run, so out of date
+            try:
+                os.remove(os.path.join(out_dir, name))
+            except FileNotFoundError:
+                pass
+        error_count = len(program.diagnostics)
+    except Exception as e:      # One bad file mustn't stop the batch
+        status, error_count, message = 'failed', 0, str(e)
+    return status, error_count, time.perf_counter() - start, message
+
+def check_file(job):
+    """ Worker for assemble_batch with --check: check one ASM file (see
+    check_program).  job and the result are as for assemble_file, but
+    out_dir is unused, and nothing is written.
+    """
+    asm_filename, out_dir, options = job
+    start = time.perf_counter()
+    try:
+        with open(asm_filename) as file_asm:
+            diagnostics = check_program(file_asm, options)
+        status = 'error' if diagnostics else 'ok'
+        message = str(diagnostics[0]) if diagnostics else ''
+        error_count = len(diagnostics)
+    except Exception as e:      # One bad file mustn't stop the batch
+        status, error_count, message = 'failed', 0, str(e)
+    return status, error_count, time.perf_counter() - start, message
+
+def assemble_batch(options, file_summary=sys.stdout):
+    """ Assemble options.files (see batch_files), options.jobs of them at
+    once, each into its own directory under options.outdir; or with
+    options.check, only check them.  Prints a summary line for each file
+    as it finishes (in order), then a total.  Returns the number of files
+    which didn't assemble.
+    """
+    start = time.perf_counter()
+    filenames = options.files
+    file_options = copy.copy(options)
+    file_options.jobs = 1       # Files are parallel, not their chunks
+    if options.check:
+        worker = check_file
+        out_dirs = [None] * len(filenames)
+    else:
+        worker = assemble_file
+        out_dirs = batch_output_dirs(filenames, options.outdir)
+    jobs = [(filename, out_dir, file_options)
+            for filename, out_dir in zip(filenames, out_dirs)]
+    if options.jobs > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(options.jobs)
+        results = pool.imap(worker, jobs)
+    else:
+        pool = None
+        results = map(worker, jobs)
+
+    counts = {'ok': 0, 'error': 0, 'failed': 0}
+    for filename, (status, error_count, seconds, message) in zip(filenames,
+                                                                  results):
+        counts[status] += 1
+        line = "{:<6} {:>2} {:8.3f}s  {}".format(status, error_count, seconds,
+                                                filename)
+        if message:
+            line += '  (' + message + ')'
+        print(line, file=file_summary)
+    if pool:
+        pool.close()
+        pool.join()
+
+    print("{} files: {} ok, {} with errors, {} failed in {:.3f}s".format(
+          len(filenames), counts['ok'], counts['error'], counts['failed'],
+          time.perf_counter() - start), file=file_summary)
+    return counts['error'] + counts['failed']
+
+# Options of a server request, see serve_request.  Not jobs: the server's
+# threads mustn't fork worker processes
+SERVER_OPTIONS = ('whole_file', 'one_pass', 'numpy', 'sparse',
+                  'bin_file', 'bin_span', 'ihex_file')
+
+def serve_request(request):
+    """ Assemble for a client of the server.  request is a dict holding the
+    source text, and any of the SERVER_OPTIONS.  Returns the response dict,
+    see program_outputs.
+    """
+    options = default_options()
+    for name in SERVER_OPTIONS:
+        if name in request:
+            setattr(options, name, request[name])
+    return program_outputs(assemble(request['source'], options))
+
+def server_classes():
+    """ Define AssemblerRequestHandler and AssemblerServer, on first use so
+    that only a server imports socketserver.
+    """
+    global AssemblerRequestHandler, AssemblerServer
+    if 'AssemblerServer' in globals():
+        return
+    import json, socket, socketserver, stat
+
+    class AssemblerRequestHandler(socketserver.StreamRequestHandler):
+        """ A request is a JSON object (see serve_request), sent by the client
+        before it shuts down its side of the socket.  The response is a JSON
+        object: that of serve_request, or {'error': message} if the request
+        couldn't be served.
+        """
 
-    (file_asm, file_list, file_mem, file_sym, file_mif) =  parse_command_line()
+        def handle(self):
+            request = self.rfile.read()
+            if not request:
+                return      # Just a connection, as from remove_stale_socket
+            try:
+                response = serve_request(json.loads(request))
+            except Exception as e:
+                response = {'error': type(e).__name__ + ': ' + str(e)}
+            self.wfile.write(json.dumps(response).encode())
+
+    class AssemblerServer(socketserver.ThreadingMixIn,
+                          socketserver.UnixStreamServer):
+        """ Serves assemble requests on a Unix socket, each on a thread of its
+        own.  Every request is assembled in an AssemblerSession of its own, so
+        requests don't need to wait for each other.  RuntimeError is raised
+        if something other than the socket of a server that has gone is at
+        socket_path.
+        """
+        daemon_threads = True
+
+        def __init__(self, socket_path):
+            self.remove_stale_socket(socket_path)
+            socketserver.UnixStreamServer.__init__(self, socket_path,
+                                                   AssemblerRequestHandler)
+
+        @staticmethod
+        def remove_stale_socket(socket_path):
+            """ Remove the socket at socket_path if it's left over from an
+            earlier server: one no server accepts connections on.
+            """
+            try:
+                mode = os.lstat(socket_path).st_mode
+            except FileNotFoundError:
+                return
+            if not stat.S_ISSOCK(mode):
+                raise RuntimeError(socket_path + " exists and isn't a " +
+                                   "socket, so can't serve on it")
+            probe = socket.socket(socket.AF_UNIX)
+            try:
+                probe.connect(socket_path)
+            except ConnectionRefusedError:
+                os.unlink(socket_path)
+                return
+            finally:
+                probe.close()
+            raise RuntimeError("A server is already running on " +
+                               socket_path)
+
+        def server_close(self):
+            socketserver.UnixStreamServer.server_close(self)
+            if os.path.exists(self.server_address):
+                os.unlink(self.server_address)
+
+def serve(socket_path):
+    """ Run an AssemblerServer until interrupted or terminated """
+    import signal
+    server_classes()
+    try:
+        server = AssemblerServer(socket_path)
+    except RuntimeError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    except OSError as e:
+        print("Can't serve on " + socket_path + ": " + str(e),
+              file=sys.stderr)
+        sys.exit(1)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def program_outputs(program):
+    """ Everything a Program (or SavedProgram) writes, as a dict which can
+    be sent or stored as JSON: diagnostics, a list of [type name, line
+    number, reason text], and if there are none the text of the output
+    files (list, symbols, mem and mif, and if asked for, bin: the binary
+    image in base64, and ihex).
+    """
+    outputs = {'diagnostics': [[type(error).__name__, error.line_number,
+                                error.reason_text]
+                               for error in program.diagnostics]}
+    if program.ok:
+        for name, write in (('list', program.write_list),
+                            ('symbols', program.write_symbols),
+                            ('mem', program.write_mem),
+                            ('mif', program.write_mif)):
+            text = io.StringIO()
+            write(text)
+            outputs[name] = text.getvalue()
+        if program.writes_bin:
+            import base64
+            data = io.BytesIO()
+            program.write_bin(data)
+            outputs['bin'] = base64.b64encode(data.getvalue()).decode()
+        if program.writes_ihex:
+            text = io.StringIO()
+            program.write_ihex(text)
+            outputs['ihex'] = text.getvalue()
+    return outputs
+
+class SavedProgram:
+    """ A Program rebuilt from its program_outputs (from the server, or the
+    cache), with the same diagnostics, ok and write_ methods.  Nothing is
+    assembled; this just holds the text of the outputs.
+    """
 
-    line_number = 1
-    mem_address = None  # In case there is no .ORG statement, need to detect
-    code = []  # List of AsmLine objects
-    syntax_errors = 0
-    MAX_SYNTAX_ERRORS = 5
+    def __init__(self, outputs):
+        errors = {'SyntaxError': SyntaxError, 'ParseError': ParseError}
+        self.diagnostics = [errors[name](line_number, reason_text)
+                            for name, line_number, reason_text
+                            in outputs['diagnostics']]
+        self.outputs = outputs
 
-    # First pass, assemble as much as possible.  Build symbol table
-    for line in file_asm:
-        try:
-            a = AsmLine(line, line_number, mem_address)
-            code.append(a)
-            line_number += 1
-            mem_address = a.next_mem_address()
-        except SyntaxError as se:
-            syntax_errors += 1
-            print(se, file=sys.stderr)
-            if syntax_errors > MAX_SYNTAX_ERRORS:
-                sys.exit(syntax_errors)
+    @property
+    def ok(self):
+        return not self.diagnostics
 
+    def write_list(self, file):
+        file.write(self.outputs['list'])
 
-    if syntax_errors > 0:
-        sys.exit(syntax_errors)
+    def write_symbols(self, file):
+        file.write(self.outputs['symbols'])
 
-    file_asm.close()
-    # Print the symbol table
-    print(SymbolTable.printable_string(), file=file_sym)
-    file_sym.close()
+    def write_mem(self, file):
+        file.write(self.outputs['mem'])
+
+    @property
+    def writes_bin(self):
+        return 'bin' in self.outputs
+
+    def write_bin(self, file):
+        import base64
+        file.write(base64.b64decode(self.outputs['bin']))
+
+    @property
+    def writes_ihex(self):
+        return 'ihex' in self.outputs
 
-    mem_locs = [];
-    print("addr data   label     opcode  operands", file=file_list)
-    print("---- ----  --------   ------  --------", file=file_list)
+    def write_ihex(self, file):
+        file.write(self.outputs['ihex'])
 
-    for c in code:
-        c.assemble()
-        s = str(c)
-        if s != "":
-            print(s, file=file_list)
-            mem_locs.extend(c.mem_locs())
+    def write_mif(self, file):
+        file.write(self.outputs['mif'])
 
-    create_mem_file(file_mem, mem_locs);
-    create_mif_file(file_mif, mem_locs);
+def assemble_remote(socket_path, source, options):
+    """ Have the server on the Unix socket assemble the source text, with
+    the options.  Returns a SavedProgram.  Raises OSError if the server
+    can't be reached, and RuntimeError if it couldn't serve the request.
+    """
+    import json, socket
+    request = {name: getattr(options, name) for name in SERVER_OPTIONS}
+    request['source'] = source
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall(json.dumps(request).encode())
+        client.shutdown(socket.SHUT_WR)
+        with client.makefile('rb') as f:
+            response = json.loads(f.read())
+    if 'error' in response:
+        raise RuntimeError("as240 server: " + response['error'])
+    return SavedProgram(response)
+
+# Options which change what the outputs hold (the engine options don't, so
+# results assembled with any of them can be shared), and the output file
+# options, for which only whether they're given matters
+CACHE_KEY_OPTIONS = ('sparse', 'bin_span')
+CACHE_KEY_OUTPUTS = ('bin_file', 'ihex_file')
+
+# Changed when the format of an output file changes, so that results cached
+# before aren't used
+OUTPUT_FORMATS = 2
+
+class ResultCache:
+    """ A directory of assembly results (program_outputs, as JSON), named
+    by a hash of all they depend on: the source (as bytes, or text UTF-8
+    encoded), the assembler VERSION and OUTPUT_FORMATS, the
+    CACHE_KEY_OPTIONS, and which CACHE_KEY_OUTPUTS are given.  Any number of
+    processes can share the directory.  An entry is written to a temporary
+    file and renamed into place, so no process sees part of one.  Reading
+    an entry touches it, and once the entries take more than max_bytes the
+    least recently used are deleted.  The stats file holds three counters
+    (see count): hits and misses of get(), and the bytes the entries take,
+    as put() adds them up.  Only when those pass max_bytes is the directory
+    walked to evict entries (and the bytes counted again).
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.stats_file = os.path.join(directory, 'stats')
+
+    def key(self, source, options):
+        import hashlib
+        digest = hashlib.sha256()
+        digest.update(VERSION.encode() + b'\0')
+        digest.update(str(OUTPUT_FORMATS).encode() + b'\0')
+        for name in CACHE_KEY_OPTIONS:
+            digest.update(repr(getattr(options, name)).encode() + b'\0')
+        for name in CACHE_KEY_OUTPUTS:
+            digest.update(b'1\0' if getattr(options, name) else b'0\0')
+        if isinstance(source, str):
+            source = source.encode()
+        digest.update(source)
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.json')
+
+    def get(self, source, options):
+        """ Returns the SavedProgram for the source, or None """
+        import json
+        path = self.path(self.key(source, options))
+        try:
+            with open(path) as f:
+                outputs = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            outputs = None      # Not cached (or deleted while we read it)
+        if outputs:
+            self.count(hits=1)
+        else:
+            self.count(misses=1)
+        return SavedProgram(outputs) if outputs else None
+
+    def put(self, source, options, program):
+        """ Keep the results of assembling source (a Program) """
+        import json, tempfile
+        path = self.path(self.key(source, options))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                         suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(program_outputs(program), f)
+                size = f.tell()
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        hits, misses, total = self.count(added=size)
+        if total > self.max_bytes:
+            self.evict()
+
+    def count(self, hits=0, misses=0, added=0, total=None):
+        """ Add to the counters in the stats file (hits, misses and bytes),
+        or set bytes to total, holding a lock on the file (where there's
+        fcntl) so that processes don't lose each other's counts.  Returns
+        the counters.
+        """
+        try:
+            import fcntl
+        except ImportError:
+            fcntl = None
+        os.makedirs(self.directory, exist_ok=True)
+        fd = os.open(self.stats_file, os.O_RDWR | os.O_CREAT)
+        try:
+            if fcntl:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            counters = self.read_counters(os.read(fd, 64))
+            counters = [counters[0] + hits, counters[1] + misses,
+                        counters[2] + added if total is None else total]
+            text = ' '.join(map(str, counters)).encode() + b'\n'
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.write(fd, text)
+            os.ftruncate(fd, len(text))
+        finally:
+            os.close(fd)        # and so unlock it
+        return counters
+
+    @staticmethod
+    def read_counters(text):
+        """ The [hits, misses, bytes] in the text of the stats file, or
+        zeros if it doesn't hold them (say it's from an older version)
+        """
+        try:
+            counters = [int(field) for field in text.split()]
+        except ValueError:
+            counters = []
+        return counters if len(counters) == 3 else [0, 0, 0]
+
+    def entries(self):
+        """ Returns a list of (mtime, size, path) of the entries """
+        entries = []
+        for sub, dirs, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith('.json'):
+                    path = os.path.join(sub, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue    # Deleted by another process
+                    entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def evict(self):
+        """ Delete least recently used entries, down to max_bytes """
+        entries = self.entries()
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total -= size
+        self.count(total=total)
+
+    def stats(self):
+        """ Returns a printable summary of the cache """
+        entries = self.entries()
+        try:
+            with open(self.stats_file, 'rb') as f:
+                hits, misses, total = self.read_counters(f.read())
+        except OSError:
+            hits = misses = 0
+        rate = 100.0 * hits / (hits + misses) if hits + misses else 0.0
+        return ("{}: {} entries, {} bytes (limit {}), {} hits, {} misses, " +
+                "hit rate {:.1f}%").format(
+                self.directory, len(entries),
+                sum(size for mtime, size, path in entries), self.max_bytes,
+                hits, misses, rate)
+
+def main():
+
+    parser, options = parse_options()
+    if options.server:
+        serve(options.server)
+        return
+    if options.lsp:
+        sys.exit(LanguageServer(sys.stdin.buffer, sys.stdout.buffer).run())
+    if options.cache_stats:
+        print(ResultCache(options.cache, options.cache_size << 20).stats())
+        return
+    if options.batch or options.check:
+        sys.exit(min(assemble_batch(options), 255))
+    (file_asm, file_list, file_mem, file_sym, file_mif) = open_files(parser,
+                                                                     options)
+    program = None
+    if options.cache:
+        # Looked up by the bytes as read, which are decoded if not cached
+        data = file_asm.buffer.read()
+        cache = ResultCache(options.cache, options.cache_size << 20)
+        program = cache.get(data, options)
+        source = io.TextIOWrapper(io.BytesIO(data), file_asm.encoding)
+        if options.connect:
+            source = source.read()
+    elif options.connect:
+        source = file_asm.read()
+    else:
+        source = file_asm
+    cache_hit = program is not None
+    if program is None and options.connect:
+        try:
+            program = assemble_remote(options.connect, source, options)
+        except OSError:
+            pass                # No server, so assemble here
+        except RuntimeError as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+    # With --onepass the list file streams out (unless it's to be cached),
+    # to a temporary file copied to the list file if there are no errors
+    streamed = program is None and options.one_pass and not options.cache
+    if program is None:
+        if streamed:
+            import tempfile
+            list_temp = tempfile.TemporaryFile('w+')
+        program = assemble(source, options,
+                           list_file=list_temp if streamed else None)
+    if options.cache and not cache_hit:
+        cache.put(data, options, program)
+    file_asm.close()
+
+    for error in program.diagnostics:
+        if isinstance(error, ParseError):
+            raise error
+        print(error, file=sys.stderr)
+    if program.diagnostics:
+        sys.exit(len(program.diagnostics))
+
+    program.write_symbols(file_sym)
+    file_sym.close()
+    if streamed:
+        import shutil
+        list_temp.seek(0)
+        shutil.copyfileobj(list_temp, file_list)
+        list_temp.close()
+    else:
+        program.write_list(file_list)
+    program.write_mem(file_mem)
+    program.write_mif(file_mif)
+    if options.bin_file:
+        with open_output(options.bin_file, options, 'wb') as file_bin:
+            program.write_bin(file_bin)
+    if options.ihex_file:
+        with open_output(options.ihex_file, options) as file_ihex:
+            program.write_ihex(file_ihex)
 
     file_list.close()
     file_mem.close()
     file_mif.close()
 
-sys.dont_write_bytecode = True;
-
 if __name__ == '__main__':
     main()
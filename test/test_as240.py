@@ -1,8 +1,12 @@
 #! /usr/bin/env python3
 import random
 import unittest
+import array
 import as240
+import io
 import os
+import sys
+import json
 
 FORMAT_1 = '{:4} {:4}  {:8}   {:6}  {:8}'
 
@@ -642,6 +646,1371 @@ class TestAsmLine(unittest.TestCase):
         locs = a.mem_locs()
         self.assertTupleEqual((mem_address, 0b1011_000_110_100_011), locs[0])
         
+##### Integer encoding templates compiled from OpcodeInfo.opcode_info
+class TestOpcodeTemplates(unittest.TestCase):
+
+    def test_templates(self):
+        templates = as240.OpcodeInfo.templates
+        self.assertEqual(set(templates), set(as240.OpcodeInfo.opcode_info))
+        self.assertEqual(templates['ADD'], (0, ((0, 6), (1, 3), (2, 0)), None))
+        self.assertEqual(templates['SW'], (0b0011100 << 9, ((0, 3), (1, 0)), 2))
+        self.assertEqual(templates['BRA'], (0b1111100 << 9, (), 0))
+        self.assertEqual(templates['STOP'], (0b1111111 << 9, (), None))
+
+##### Operand validators compiled from OpcodeInfo.opcode_info
+class TestOpcodeValidators(unittest.TestCase):
+
+    def test_validators(self):
+        validators = as240.OpcodeInfo.validators
+        self.assertEqual(set(validators), set(as240.OpcodeInfo.opcode_info))
+        for opcode, info in as240.OpcodeInfo.opcode_info.items():
+            self.assertEqual(len(validators[opcode]), info['num_operands'] + 1)
+
+    def test_messages(self):
+        with self.assertRaises(as240.SyntaxError) as cm:
+            as240.AsmLine(' SW R1, R2', 11, 0x100)
+        self.assertEqual(cm.exception.reason_text, 'The SW instruction ' +
+                         'requires three operands, but you provided two ' +
+                         '(R1andR2)')
+        with self.assertRaises(as240.SyntaxError) as cm:
+            as240.AsmLine(' LI R1, R2', 11, 0x100)
+        self.assertEqual(cm.exception.reason_text, 'A LI statement requires ' +
+                         'the second operand not be a register, but you ' +
+                         'provided R2')
+
+##### Operands are classified once, and remembered
+class TestOperandCache(unittest.TestCase):
+
+    def test_classify(self):
+        cache = as240.OperandCache()
+        self.assertEqual(cache.classify('R5'), ('register', 5))
+        self.assertEqual(cache.classify('$01FF'), ('hex', 0x1FF))
+        self.assertEqual(cache.classify('LOOP_1'), ('label', None))
+        self.assertEqual(cache.classify('R8'), ('label', None))
+        self.assertEqual(cache.classify('$12345'), ('invalid', None))
+        self.assertEqual(cache.classify('%EAX'), ('invalid', None))
+        self.assertEqual(len(cache), 6)
+        cache.classify('R5')
+        self.assertEqual(len(cache), 6)
+
+    def test_shared_across_lines(self):
+        cache = as240.AssemblerSession.default.operand_cache
+        cache.clear()
+        for mem_address in range(0x100, 0x120, 2):
+            as240.AsmLine(' ADD R1, R2, R1', 10, mem_address)
+        self.assertEqual(len(cache), 2)
+
+    def test_DW_undefined_label(self):
+        a = as240.AsmLine(' .DW NOWHERE', line_number=12, mem_address=0x100)
+        with self.assertRaises(as240.SyntaxError):
+            a.assemble()
+
+##### Repeated statements are parsed and validated once
+class TestStatementCache(unittest.TestCase):
+
+    def test_LRUCache(self):
+        cache = as240.LRUCache(maxsize=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)      # evicts b, the least recently used
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+    def test_repeated_statement(self):
+        as240.AssemblerSession.default.statement_cache.clear()
+        a = as240.AsmLine('SC_LBL1 ADD R1, R1, R2 ; first', 10, 0x100)
+        b = as240.AsmLine('\tADD R1, R1, R2\n', 11, 0x102)
+        c = as240.AsmLine('SC_LBL2  ADD R1, R1, R2', 12, 0x104)
+        self.assertEqual(as240.AssemblerSession.default.statement_cache.misses, 1)
+        self.assertEqual(as240.AssemblerSession.default.statement_cache.hits, 2)
+        self.assertEqual((a.label, b.label, c.label),
+                         ('SC_LBL1', None, 'SC_LBL2'))
+        for line in (a, b, c):
+            self.assertEqual((line.opcode, line.operand1, line.operand2,
+                              line.operand3), ('ADD', 'R1', 'R1', 'R2'))
+        self.assertEqual(as240.SymbolTable.lookup_label('SC_LBL2', 12), 0x104)
+
+    def test_repeated_error(self):
+        for line_number in (20, 21):
+            with self.assertRaises(as240.SyntaxError) as cm:
+                as240.AsmLine(' ADD R1, R1, $2', line_number, 0x100)
+            self.assertEqual(cm.exception.line_number, line_number)
+            with self.assertRaises(as240.ParseError) as cm:
+                as240.AsmLine(' ADD R1 R1, R2', line_number, 0x100)
+            self.assertEqual(cm.exception.line_number, line_number)
+
+##### Parsing a line into label, opcode and operand fields
+class TestStatementParsing(unittest.TestCase):
+
+    def test_blank_and_comment(self):
+        for line in ['', '\n', '   \t \n', '  ; just a comment\n']:
+            a = as240.AsmLine(line, line_number=10, mem_address=None)
+            self.assertTrue(a.is_valid)
+            self.assertIsNone(a.label)
+            self.assertIsNone(a.opcode)
+
+    def test_label_only(self):
+        a = as240.AsmLine('P_LBL1   ; comment\n', line_number=10, mem_address=500)
+        self.assertEqual(a.label, 'P_LBL1')
+        self.assertIsNone(a.opcode)
+
+    def test_operands_without_whitespace(self):
+        a = as240.AsmLine('P_LBL2 lw r7,r0,$12\n', line_number=10, mem_address=500)
+        self.assertEqual((a.label, a.opcode), ('P_LBL2', 'LW'))
+        self.assertEqual((a.operand1, a.operand2, a.operand3), ('R7', 'R0', '$12'))
+        a = as240.AsmLine('\tmv r1 ,r2', line_number=10, mem_address=500)
+        self.assertEqual((a.label, a.opcode), (None, 'MV'))
+        self.assertEqual((a.operand1, a.operand2, a.operand3), ('R1', 'R2', None))
+
+    def test_ParseError(self):
+        with self.assertRaises(as240.ParseError):
+            as240.AsmLine(' ADD R1 R2, R3', line_number=11, mem_address=502)
+        with self.assertRaises(as240.ParseError):
+            as240.AsmLine('P_LBL3 LW R1, R2, $1 $2', line_number=11, mem_address=502)
+
+##### Tokenizing a whole file in one pass (--wholefile)
+class TestScanStatements(unittest.TestCase):
+
+    def fields(self, line, fields):
+        a = as240.AsmLine(line, line_number=10, mem_address=500, fields=fields)
+        return (a.label, a.opcode, a.operand1, a.operand2, a.operand3)
+
+    def test_same_fields_as_per_line(self):
+        as240.SymbolTable.clear()
+        asm_filename = os.path.join(os.path.dirname(__file__), 'testcode2.asm')
+        with open(asm_filename) as f:
+            lines = f.readlines()
+            f.seek(0)
+            statements = list(as240.scan_statements(f.read()))
+        self.assertEqual([line for line, fields in statements], lines)
+        for line, fields in statements:
+            if fields and not (fields[0] or fields[1]):
+                continue
+            as240.SymbolTable.clear()
+            try:
+                expected = self.fields(line, None)
+            except as240.SyntaxError:
+                continue
+            as240.SymbolTable.clear()
+            self.assertEqual(self.fields(line, fields), expected)
+
+    def test_unparseable_line(self):
+        statements = list(as240.scan_statements(' ADD R1 R2, R3 ; c\n STOP'))
+        self.assertEqual(statements[0], (' ADD R1 R2, R3 ; c\n', None))
+        self.assertEqual(statements[1][0], ' STOP')
+        self.assertEqual(statements[1][1][1], 'STOP')
+
+    def test_repeated_lines_matched_once(self):
+        statements = list(as240.scan_statements(
+                              ' ADD R1, R2, R3\n STOP\n ADD R1, R2, R3\n'))
+        self.assertIs(statements[0][1], statements[2][1])
+
+##### AsmLine objects are kept for every line, so must stay small
+class TestAsmLineFootprint(unittest.TestCase):
+
+    def test_slots(self):
+        a = as240.AsmLine('FP_LBL1 ADD R1, R2, R3 ; comment\n', 10, 0x100, None, 40)
+        a.assemble()
+        self.assertFalse(hasattr(a, '__dict__'))
+        if sys.maxsize > 2**32:
+            self.assertLessEqual(sys.getsizeof(a), 128)
+
+    def test_interned(self):
+        a = as240.AsmLine(' ADD r1, r2, r3', 10, 0x100)
+        b = as240.AsmLine(' SUB R1 , R2 , R3', 11, 0x102)
+        self.assertIs(a.operand1, b.operand1)
+        self.assertIs(a.operand3, b.operand3)
+
+    def test_source_line(self):
+        source = '    .ORG $100\nFP_LBL2 STOP ; done\n'
+        a = as240.AsmLine('FP_LBL2 STOP ; done\n', 2, 0x100, None, 14)
+        self.assertEqual(a.source_line(source), 'FP_LBL2 STOP ; done')
+
+def first_pass(asm_filename):
+    """ Build the AsmLines of a test program, as main() does """
+    as240.SymbolTable.clear()
+    code = []
+    mem_address = None
+    with open(os.path.join(os.path.dirname(__file__), asm_filename)) as f:
+        for line_number, line in enumerate(f, 1):
+            a = as240.AsmLine(line, line_number, mem_address)
+            mem_address = a.next_mem_address()
+            if a.label or a.opcode:
+                code.append(a)
+    return code
+
+##### The NumPy engine must match AsmLine.assemble bit for bit
+@unittest.skipIf(as240.numpy is None, 'numpy is not installed')
+class TestAssembleColumnar(unittest.TestCase):
+
+    def test_same_as_assemble(self):
+        code = first_pass('testcode1.asm')
+        expected_locs = []
+        for c in code:
+            c.assemble()
+            expected_locs.extend(c.mem_locs())
+        expected_words = [(c.word1, c.word2) for c in code]
+        code = first_pass('testcode1.asm')
+        self.assertEqual(as240.assemble_columnar(code), expected_locs)
+        self.assertEqual([(c.word1, c.word2) for c in code], expected_words)
+
+    def test_undefined_label(self):
+        as240.SymbolTable.clear()
+        code = [as240.AsmLine(' .ORG $100', 1, None),
+                as240.AsmLine(' BRA NOWHERE', 2, 0x100)]
+        with self.assertRaises(as240.SyntaxError) as cm:
+            as240.assemble_columnar(code)
+        self.assertEqual(cm.exception.line_number, 2)
+
+##### One-pass assembly, patching forward references
+class TestOnePass(unittest.TestCase):
+
+    def one_pass(self, text):
+        session = as240.AssemblerSession()
+        statements = [(line, None) for line in io.StringIO(text)]
+        listing = []
+        locs = as240.assemble_one_pass(statements, listing.append, session)
+        return [str(error) for error in session.diagnostics], locs, listing
+
+    def test_forward_references(self):
+        errors, locs, listing = self.one_pass(
+            '  .ORG $10\n  BRA OP_X\n  LI R1, OP_X\nOP_X .DW OP_Y\nOP_Y STOP\n')
+        self.assertEqual(errors, [])
+        self.assertEqual(locs, [(0x10, 0xF800), (0x12, 0x18), (0x14, 0x3040),
+                                (0x16, 0x18), (0x18, 0x1A), (0x1A, 0xFE00)])
+        self.assertEqual(listing[0].splitlines(),
+                         ['0010 F800             BRA             ',
+                          '0012 0018                     OP_X    '])
+
+    def test_undefined_labels(self):
+        errors, locs, listing = self.one_pass(
+            '  .ORG $10\n  BRA OP_NOPE\n  STOP\n .DW OP_NOPE2\n')
+        self.assertEqual(errors,
+            ['Syntax Error on line 2:  The label OP_NOPE has not been ' +
+             'defined anywhere.',
+             'Syntax Error on line 4:  The label OP_NOPE2 has not been ' +
+             'defined anywhere.'])
+
+    def test_list_file_streams(self):
+        options = as240.default_options()
+        options.one_pass = True
+        list_file = io.StringIO()
+        listed = []
+        def lines():
+            yield '  .ORG $10\n'
+            yield '  STOP\n'
+            listed.append(list_file.getvalue().count('\n'))
+            yield '  BRA OP_W\n'
+            yield '  STOP\n'
+            listed.append(list_file.getvalue().count('\n'))
+            yield 'OP_W STOP\n'
+            listed.append(list_file.getvalue().count('\n'))
+        program = as240.assemble(lines(), options, list_file=list_file)
+        self.assertIsNone(program.listing)
+        self.assertEqual(listed, [3, 3, 7])
+        expected = io.StringIO()
+        as240.assemble(list(lines())).write_list(expected)
+        self.assertEqual(list_file.getvalue(), expected.getvalue())
+
+    def test_list_file_on_errors(self):
+        import tempfile
+        from unittest.mock import patch
+        with tempfile.TemporaryDirectory() as tmp:
+            asm_name = os.path.join(tmp, 'prog.asm')
+            list_name = os.path.join(tmp, 'prog.list')
+            lists = []
+            body = ' .ORG $0\n' + ' ADD r1, r2, r3\n' * 3000
+            for source in (body + ' FOO\n', body + ' STOP\n'):
+                with open(asm_name, 'w') as f:
+                    f.write(source)
+                for flags in ([], ['--onepass']):
+                    argv = ['as240.py', '-l', list_name, '-m',
+                            os.path.join(tmp, 'memory.hex'), '--miffilename',
+                            os.path.join(tmp, 'memory.mif')] + flags
+                    with patch(target='sys.argv', new=argv + [asm_name]), \
+                         patch(target='sys.stderr', new=io.StringIO()):
+                        try:
+                            as240.main()
+                        except SystemExit:
+                            pass
+                    with open(list_name) as f:
+                        lists.append(f.read())
+        self.assertEqual(lists[0], '')
+        self.assertEqual(lists[1], '')
+        self.assertEqual(lists[3], lists[2])
+        self.assertIn('ADD     R1 R2 R3', lists[3])
+
+    def test_same_as_two_pass(self):
+        options = as240.default_options()
+        options.one_pass = True
+        for source in (' .ORG $0\n FOO\n BRA NOWHERE\n STOP\n',
+                       ' .ORG $0\n BRA NOWHERE\n STOP\n',
+                       ' .ORG $0\n BRA OP_Z\n FOO R1\nOP_Z STOP\n',
+                       ' .ORG $0\n LI R1, OP_Z\nOP_Z .DW OP_Z\n'):
+            expected = as240.assemble(source)
+            program = as240.assemble(source, options)
+            self.assertEqual([str(error) for error in program.diagnostics],
+                             [str(error) for error in expected.diagnostics])
+            self.assertEqual(program.mem_locs, expected.mem_locs)
+            self.assertEqual(program.listing, expected.listing)
+
+##### Parsing in chunks on several processes must match first_pass
+class TestParseParallel(unittest.TestCase):
+
+    def parse(self, parse, text):
+        session = as240.AssemblerSession()
+        code = parse(io.StringIO(text).readlines(), session)
+        if session.diagnostics:
+            return [str(error) for error in session.diagnostics]
+        return ([(a.line_number, a.mem_address, a.assemble(session))
+                 for a in code], session.symbols.table)
+
+    def assertSameAsFirstPass(self, text, chunk_size):
+        serial = self.parse(lambda lines, session: as240.first_pass(
+                                ((line, None) for line in lines), session),
+                            text)
+        parallel = self.parse(lambda lines, session: as240.parse_parallel(
+                                lines, 2, chunk_size, session), text)
+        self.assertEqual(serial, parallel)
+        return parallel
+
+    def test_addresses_across_chunks(self):
+        text = ('  .ORG $10\nA1 ADD R1, R2, R3\n  LI R1, A2\nA2 STOP\n' +
+                '  .ORG $40\n  BRA A1\nA3\n  .DW A3\n')
+        for chunk_size in (1, 2, 3):
+            words, symbols = self.assertSameAsFirstPass(text, chunk_size)
+            self.assertEqual(symbols, {'A1': 0x10, 'A2': 0x16, 'A3': 0x44})
+
+    def test_errors_across_chunks(self):
+        text = ('A1 STOP\n  .ORG $10\nA1 STOP\n  FOO R1\nA2 .DW $1\n' +
+                'A2 STOP\n')
+        errors = self.assertSameAsFirstPass(text, 2)
+        self.assertEqual(len(errors), 4)
+        self.assertEqual(errors[0],
+                         'Syntax Error on line 1:  You must use .ORG to ' +
+                         'initialize a memory section before any line with ' +
+                         'a label or opcode')
+
+    def test_testcode(self):
+        with open(os.path.join(os.path.dirname(__file__),
+                               'testcode1.asm')) as f:
+            text = f.read()
+        self.assertSameAsFirstPass(text, 7)
+
+##### Each assembly has a session of its own
+class TestAssemblerSession(unittest.TestCase):
+
+    def assemble_testcode(self, session):
+        path = os.path.join(os.path.dirname(__file__), 'testcode1.asm')
+        with open(path) as f:
+            code = as240.first_pass(((line, None) for line in f), session)
+        for a in code:
+            a.assemble(session)
+        return [loc for a in code for loc in a.mem_locs()]
+
+    def test_separate_symbol_tables(self):
+        first = as240.AssemblerSession()
+        second = as240.AssemblerSession()
+        as240.AsmLine('SS_LBL STOP', 10, 0x100, session=first)
+        as240.AsmLine('SS_LBL STOP', 10, 0x200, session=second)
+        self.assertEqual(first.symbols.lookup_label('SS_LBL', 10), 0x100)
+        self.assertEqual(second.symbols.lookup_label('SS_LBL', 10), 0x200)
+        self.assertFalse(as240.SymbolTable.has_label('SS_LBL'))
+        a = as240.AsmLine(' .DW SS_LBL', 11, 0x102, session=first)
+        a.assemble(first)
+        self.assertEqual(a.word1, 0x100)
+        with self.assertRaises(as240.SyntaxError):
+            a.assemble()    # not defined in the default session
+
+    def test_default_session(self):
+        as240.SymbolTable.clear()
+        as240.AsmLine('DS_LBL STOP', 10, 0x100)
+        self.assertEqual(as240.AssemblerSession.default.symbols.table,
+                         {'DS_LBL': 0x100})
+        self.assertIs(as240.SymbolTable.table,
+                      as240.AssemblerSession.default.symbols.table)
+
+    def test_concurrent_sessions(self):
+        from concurrent.futures import ThreadPoolExecutor
+        expected = self.assemble_testcode(as240.AssemblerSession())
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            results = list(pool.map(self.assemble_testcode,
+                                    [as240.AssemblerSession()
+                                     for i in range(8)]))
+        self.assertEqual(results, [expected] * 8)
+
+##### Assembling in memory, as a library
+class TestAssemble(unittest.TestCase):
+
+    source = ('  .ORG $10\nSTART LI R1, DATA\n  BRA START\n' +
+              'DATA .DW $1234\n')
+
+    def test_program(self):
+        program = as240.assemble(self.source)
+        self.assertTrue(program.ok)
+        self.assertEqual(program.symbols, {'START': 0x10, 'DATA': 0x18})
+        self.assertEqual(program.mem_locs,
+                         [(0x10, 0x3040), (0x12, 0x18), (0x14, 0xF800),
+                          (0x16, 0x10), (0x18, 0x1234)])
+        self.assertEqual(len(program.listing), 3)
+        mem = io.StringIO()
+        program.write_mem(mem)
+        self.assertEqual(mem.getvalue().split()[8:13],
+                         ['3040', '0018', 'F800', '0010', '1234'])
+
+    def test_same_for_every_option(self):
+        lines = io.StringIO(self.source).readlines()
+        expected = as240.assemble(self.source).mem_locs
+        for option in ('whole_file', 'one_pass'):
+            options = as240.default_options()
+            setattr(options, option, True)
+            self.assertEqual(as240.assemble(lines, options).mem_locs,
+                             expected)
+
+    def test_diagnostics(self):
+        program = as240.assemble('  .ORG $10\n  FOO\n  BRA NOWHERE\n')
+        self.assertFalse(program.ok)
+        self.assertEqual([str(error) for error in program.diagnostics],
+                         ['Syntax Error on line 2:  Invalid opcode (FOO)'])
+        program = as240.assemble('  .ORG $10\n  BRA NOWHERE\n')
+        self.assertEqual([str(error) for error in program.diagnostics],
+                         ['Syntax Error on line 2:  The label NOWHERE has ' +
+                          'not been defined anywhere.'])
+        self.assertEqual(program.mem_locs, [])
+        program = as240.assemble('  .ORG $10\n  ADD R1 R2, R3\n')
+        self.assertIsInstance(program.diagnostics[0], as240.ParseError)
+
+    def test_dw_without_operand(self):
+        source = '  .ORG $10\n  .DW\n  STOP\n'
+        for option in ('whole_file', 'one_pass', 'numpy'):
+            if option == 'numpy' and as240.numpy is None:
+                continue
+            options = as240.default_options()
+            setattr(options, option, True)
+            program = as240.assemble(source, options)
+            self.assertEqual(program.mem_locs, [(0x10, 0), (0x12, 0xFE00)])
+            self.assertEqual(program.listing[0].split(), ['0010', '0000',
+                                                          '.DW'])
+        engine = as240.IncrementalAssembler(source)
+        self.assertEqual(engine.image, {0x10: 0, 0x12: 0xFE00})
+
+##### Assembling many files at once (--batch)
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = self.tmp.name
+        here = os.path.dirname(os.path.abspath(__file__))
+        for name in ('testcode1.asm', 'testcode2.asm'):
+            with open(os.path.join(here, name)) as f:
+                text = f.read()
+            with open(os.path.join(self.dir, name), 'w') as f:
+                f.write(text)
+        with open(os.path.join(self.dir, 'manifest'), 'w') as f:
+            f.write('# submissions\ntestcode2.asm\n\nmissing.asm\n')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_batch_files(self):
+        pattern = os.path.join(self.dir, '*.asm')
+        manifest = '@' + os.path.join(self.dir, 'manifest')
+        self.assertEqual(as240.batch_files([pattern, manifest]),
+                         [os.path.join(self.dir, name) for name in
+                          ('testcode1.asm', 'testcode2.asm', 'missing.asm')])
+
+    def test_batch_output_dirs(self):
+        self.assertEqual(as240.batch_output_dirs(
+                             ['a/t.asm', 'b/t.asm', 'u.asm', 'c/t.asm'], 'out'),
+                         [os.path.join('out', name)
+                          for name in ('t', 't-2', 'u', 't-3')])
+
+    def test_assemble_batch(self):
+        from unittest.mock import patch
+        out = os.path.join(self.dir, 'out')
+        argv = ['as240.py', '--batch', '--outdir', out,
+                os.path.join(self.dir, 'testcode1.asm'),
+                '@' + os.path.join(self.dir, 'manifest')]
+        with patch(target='sys.argv', new=argv):
+            parser, options = as240.parse_options()
+        summary = io.StringIO()
+        self.assertEqual(as240.assemble_batch(options, summary), 2)
+        lines = summary.getvalue().splitlines()
+        self.assertEqual([line.split()[:2] for line in lines[:3]],
+                         [['ok', '0'], ['error', '6'], ['failed', '0']])
+        self.assertTrue(lines[3].startswith(
+                        '3 files: 1 ok, 1 with errors, 1 failed'))
+        self.assertEqual(sorted(os.listdir(os.path.join(out, 'testcode1'))),
+                         ['memory.hex', 'memory.mif', 'testcode1.list',
+                          'testcode1.sym'])
+        self.assertEqual(os.listdir(os.path.join(out, 'testcode2')),
+                         ['testcode2.err'])
+
+    def test_batch_removes_stale_outputs(self):
+        from unittest.mock import patch
+        out = os.path.join(self.dir, 'out')
+        asm_filename = os.path.join(self.dir, 'prog.asm')
+        argv = ['as240.py', '--batch', '--outdir', out, '--ihexfile',
+                'memory.ihex', asm_filename]
+        with patch(target='sys.argv', new=argv):
+            parser, options = as240.parse_options()
+        outputs = ['memory.hex', 'memory.ihex', 'memory.mif', 'prog.list',
+                   'prog.sym']
+        for source, expected in (('  .ORG $0\n  STOP\n', outputs),
+                                 ('  .ORG $0\n  FOO\n', ['prog.err']),
+                                 ('  .ORG $0\n  STOP\n', outputs)):
+            with open(asm_filename, 'w') as f:
+                f.write(source)
+            as240.assemble_batch(options, io.StringIO())
+            self.assertEqual(sorted(os.listdir(os.path.join(out, 'prog'))),
+                             expected)
+
+    def test_check_program(self):
+        for source in ('  .ORG $0\n  BRA NOWHERE\nX ADD R1, R2, R3\n',
+                       '  .ORG $0\n  FOO R1\n  .DW $1\n  BAR\n',
+                       '  .ORG $0\nX .DW X\n'):
+            self.assertEqual(
+                [str(d) for d in as240.check_program(source)],
+                [str(d) for d in as240.assemble(source).diagnostics])
+
+    def test_check_batch(self):
+        from unittest.mock import patch
+        argv = ['as240.py', '--check', '-j', '2',
+                os.path.join(self.dir, 'testcode1.asm'),
+                '@' + os.path.join(self.dir, 'manifest')]
+        with patch(target='sys.argv', new=argv):
+            parser, options = as240.parse_options()
+        summary = io.StringIO()
+        self.assertEqual(as240.assemble_batch(options, summary), 2)
+        lines = summary.getvalue().splitlines()
+        self.assertEqual([line.split()[:2] for line in lines[:3]],
+                         [['ok', '0'], ['error', '6'], ['failed', '0']])
+        self.assertIn('Syntax Error on line', lines[1])
+        self.assertEqual(sorted(os.listdir(self.dir)),
+                         ['manifest', 'testcode1.asm', 'testcode2.asm'])
+
+##### Assembling on a server, over a Unix socket
+class TestServer(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile, threading
+        self.tmp = tempfile.TemporaryDirectory()
+        self.socket_path = os.path.join(self.tmp.name, 'as240.sock')
+        self.server = as240.AssemblerServer(self.socket_path)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       args=(0.05, ))
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        self.tmp.cleanup()
+
+    def outputs(self, program):
+        texts = []
+        for write in (program.write_list, program.write_symbols,
+                      program.write_mem, program.write_mif):
+            text = io.StringIO()
+            write(text)
+            texts.append(text.getvalue())
+        return texts
+
+    def test_same_as_local(self):
+        with open(os.path.join(os.path.dirname(__file__),
+                               'testcode1.asm')) as f:
+            source = f.read()
+        options = as240.default_options()
+        remote = as240.assemble_remote(self.socket_path, source, options)
+        self.assertTrue(remote.ok)
+        self.assertEqual(self.outputs(remote),
+                         self.outputs(as240.assemble(source, options)))
+
+    def test_diagnostics(self):
+        remote = as240.assemble_remote(self.socket_path,
+                                       '  .ORG $10\n  FOO\n  ADD R1 R2, R3\n',
+                                       as240.default_options())
+        self.assertEqual([type(error) for error in remote.diagnostics],
+                         [as240.SyntaxError, as240.ParseError])
+        self.assertEqual(str(remote.diagnostics[0]),
+                         'Syntax Error on line 2:  Invalid opcode (FOO)')
+
+    def test_no_jobs(self):
+        from unittest.mock import patch
+        options = as240.default_options()
+        options.jobs = 4
+        with patch.object(as240, 'parse_parallel',
+                          side_effect=AssertionError('forked a pool')):
+            remote = as240.assemble_remote(self.socket_path,
+                                           '  .ORG $10\n  STOP\n', options)
+            response = as240.serve_request({'source': '  .ORG $10\n',
+                                            'jobs': 4})
+        self.assertTrue(remote.ok)
+        self.assertEqual(response['diagnostics'], [])
+
+    def test_no_server(self):
+        with self.assertRaises(OSError):
+            as240.assemble_remote(self.socket_path + '.none', '',
+                                  as240.default_options())
+
+    def test_not_a_socket(self):
+        path = os.path.join(self.tmp.name, 'notes.txt')
+        with open(path, 'w') as f:
+            f.write('notes\n')
+        with self.assertRaises(RuntimeError):
+            as240.AssemblerServer(path)
+        with open(path) as f:
+            self.assertEqual(f.read(), 'notes\n')
+
+    def test_server_running(self):
+        with self.assertRaises(RuntimeError):
+            as240.AssemblerServer(self.socket_path)
+        remote = as240.assemble_remote(self.socket_path, '',
+                                       as240.default_options())
+        self.assertTrue(remote.ok)
+
+    def test_stale_socket(self):
+        import socket
+        path = os.path.join(self.tmp.name, 'stale.sock')
+        stale = socket.socket(socket.AF_UNIX)
+        stale.bind(path)
+        stale.close()
+        server = as240.AssemblerServer(path)
+        server.server_close()
+        self.assertFalse(os.path.exists(path))
+
+##### Assembly results kept in a cache directory (--cache)
+class TestResultCache(unittest.TestCase):
+
+    source = '  .ORG $10\nSTART BRA START\n'
+
+    def setUp(self):
+        import tempfile
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = as240.ResultCache(os.path.join(self.tmp.name, 'cache'),
+                                       max_bytes=1 << 20)
+        self.options = as240.default_options()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_hit_and_miss(self):
+        self.assertIsNone(self.cache.get(self.source, self.options))
+        program = as240.assemble(self.source)
+        self.cache.put(self.source, self.options, program)
+        saved = self.cache.get(self.source, self.options)
+        self.assertEqual(as240.program_outputs(saved),
+                         as240.program_outputs(program))
+        self.assertIsNone(self.cache.get(self.source + '\n', self.options))
+        self.assertIn('1 entries', self.cache.stats())
+        self.assertIn('1 hits, 2 misses, hit rate 33.3%', self.cache.stats())
+
+    def test_key(self):
+        key = self.cache.key(self.source, self.options)
+        self.assertEqual(self.cache.key(self.source.encode(), self.options),
+                         key)
+        self.assertNotEqual(self.cache.key(self.source.replace('\n', '\r\n')
+                                           .encode(), self.options), key)
+        self.options.bin_file = 'a.bin'
+        bin_key = self.cache.key(self.source, self.options)
+        self.assertNotEqual(bin_key, key)
+        self.options.bin_file = 'b.bin'
+        self.assertEqual(self.cache.key(self.source, self.options), bin_key)
+
+    def test_diagnostics_cached(self):
+        source = '  .ORG $10\n  FOO\n'
+        self.cache.put(source, self.options, as240.assemble(source))
+        saved = self.cache.get(source, self.options)
+        self.assertFalse(saved.ok)
+        self.assertEqual(str(saved.diagnostics[0]),
+                         'Syntax Error on line 2:  Invalid opcode (FOO)')
+
+    def test_evict_least_recently_used(self):
+        sources = [self.source + ' .DW $%X\n' % (i, ) for i in range(3)]
+        for mtime, source in enumerate(sources):
+            self.cache.put(source, self.options, as240.assemble(source))
+            path = self.cache.path(self.cache.key(source, self.options))
+            os.utime(path, (mtime, mtime))
+        self.cache.get(sources[0], self.options)      # now most recent
+        self.cache.max_bytes = os.path.getsize(path) * 2
+        self.cache.evict()
+        self.assertIsNotNone(self.cache.get(sources[0], self.options))
+        self.assertIsNone(self.cache.get(sources[1], self.options))
+        self.assertIsNotNone(self.cache.get(sources[2], self.options))
+
+    def test_stats_file_stays_small(self):
+        os.makedirs(self.cache.directory)
+        with open(self.cache.stats_file, 'w') as f:
+            f.write('+-' * 1000)        # as an older version kept it
+        for i in range(200):
+            self.cache.get(self.source, self.options)
+        self.assertIn('0 hits, 200 misses', self.cache.stats())
+        self.assertLess(os.path.getsize(self.cache.stats_file), 16)
+
+    def test_evict_only_past_max_bytes(self):
+        from unittest.mock import patch
+        sources = [self.source + ' .DW $%X\n' % (i, ) for i in range(4)]
+        with patch.object(self.cache, 'entries',
+                          wraps=self.cache.entries) as entries:
+            for source in sources[:3]:
+                self.cache.put(source, self.options, as240.assemble(source))
+            self.assertEqual(entries.call_count, 0)
+            path = self.cache.path(self.cache.key(sources[0], self.options))
+            self.cache.max_bytes = int(os.path.getsize(path) * 3.5)
+            self.cache.put(sources[3], self.options,
+                           as240.assemble(sources[3]))
+            self.assertEqual(entries.call_count, 1)
+        self.assertIn('3 entries', self.cache.stats())
+
+##### Reassembling after editing some lines
+class TestIncrementalAssembler(unittest.TestCase):
+
+    source = ('  .ORG $10\nSTART LI R1, DATA\n  BRA START\n' +
+              'DATA .DW $1234\n  .ORG $40\n  .DW DATA\n')
+
+    def assertSameAsAssemble(self, engine):
+        program = as240.assemble(engine.source)
+        self.assertEqual(engine.program().mem_locs, program.mem_locs)
+        self.assertEqual(engine.image, dict(program.mem_locs))
+        self.assertEqual(engine.program().listing, program.listing)
+
+    def test_edit_in_place(self):
+        engine = as240.IncrementalAssembler(self.source)
+        engine.edit(2, 3, '  BRN START\n')
+        self.assertSameAsAssemble(engine)
+        self.assertEqual(engine.image[0x14], 0x9800)
+
+    def test_size_change_moves_labels(self):
+        engine = as240.IncrementalAssembler(self.source)
+        engine.edit(2, 2, '  ADD R1, R2, R3\n')    # DATA moves to $1A
+        self.assertSameAsAssemble(engine)
+        self.assertEqual(engine.image[0x12], 0x1A)
+        self.assertEqual(engine.image[0x40], 0x1A)
+        engine.edit(2, 3, '')
+        self.assertSameAsAssemble(engine)
+        self.assertEqual(engine.image[0x40], 0x18)
+
+    def test_positions_work(self):
+        """ Lines are put in order (for diagnostics, duplicate labels and
+        overlapping words) without searching for them, and only the lines
+        after an edit are numbered again, once """
+        class Entries(list):
+            numbered = 0
+            def index(self, *args):
+                raise AssertionError('searched the lines')
+            def __getitem__(self, key):
+                if isinstance(key, slice):
+                    Entries.numbered += len(range(*key.indices(len(self))))
+                return list.__getitem__(self, key)
+        blocks = []
+        for block in range(100):    # each overlapping the next
+            lines = ['  .ORG ${:04X}\n'.format(block * 0x80), 'DUP  STOP\n']
+            lines += ['  FOO\n' if i % 5 == 0 else '  ADD R1, R2, R3\n'
+                      for i in range(98)]
+            blocks.append(''.join(lines))
+        engine = as240.IncrementalAssembler()
+        engine.entries = Entries()
+        engine.edit(0, 0, ''.join(blocks))
+        diagnostics = engine.diagnostics
+        self.assertEqual(len(diagnostics), 100 * 20 + 99)
+        self.assertEqual([error.line_number for error in diagnostics[:3]],
+                         [3, 8, 13])
+        self.assertEqual(diagnostics[20].line_number, 102)    # DUP
+        engine.image
+        Entries.numbered = 0
+        engine.edit(9900, 9900, '  FOO\n  ADD R1, R2, R3\n')
+        diagnostics = list(map(str, engine.diagnostics))
+        engine.image
+        self.assertLessEqual(Entries.numbered, 200)
+        Entries.numbered = 0
+        for publish in range(10):
+            self.assertEqual(list(map(str, engine.diagnostics)), diagnostics)
+        self.assertEqual(Entries.numbered, 0)
+        self.assertEqual(len(diagnostics), 100 * 20 + 99 + 1)
+        self.assertEqual(diagnostics[-22:-20],
+                         ['Syntax Error on line 9901:  Invalid opcode (FOO)',
+                          'Syntax Error on line 9904:  Duplicate label ' +
+                          '(DUP).  Label has already been declared on a ' +
+                          'previous line.'])
+
+    def test_diagnostics(self):
+        engine = as240.IncrementalAssembler(self.source)
+        engine.edit(3, 4, 'START .DW $1234\n')
+        self.assertEqual([str(error) for error in engine.diagnostics],
+            ['Syntax Error on line 2:  The label DATA has not been ' +
+             'defined anywhere.',
+             'Syntax Error on line 4:  Duplicate label (START).  Label has ' +
+             'already been declared on a previous line.',
+             'Syntax Error on line 6:  The label DATA has not been ' +
+             'defined anywhere.'])
+        engine.edit(3, 4, 'DATA .DW $1234\n')
+        self.assertEqual(engine.diagnostics, [])
+        self.assertSameAsAssemble(engine)
+
+##### Testing the language server (--lsp)
+
+class TestLanguageServer(unittest.TestCase):
+
+    uri = 'file:///tmp/prog.asm'
+    source = ('  .ORG $10\nSTART LI R1, DATA\n  BRA START\n' +
+              'DATA .DW $1234\n')
+
+    def run_server(self, *messages):
+        """ Returns the exit code and the messages the server sent.  A
+        message given as bytes is sent as it is, framing and all. """
+        stdin = io.BytesIO()
+        for message in messages:
+            if isinstance(message, bytes):
+                stdin.write(message)
+                continue
+            body = json.dumps(dict(message, jsonrpc='2.0')).encode()
+            stdin.write(b'Content-Length: ' + str(len(body)).encode() +
+                        b'\r\n\r\n' + body)
+        stdin.seek(0)
+        stdout = io.BytesIO()
+        code = as240.LanguageServer(stdin, stdout).run()
+        sent = []
+        output = stdout.getvalue()
+        while output:
+            header, _, output = output.partition(b'\r\n\r\n')
+            length = int(header.split(b':')[1])
+            sent.append(json.loads(output[:length]))
+            output = output[length:]
+        return code, sent
+
+    def open_message(self, text):
+        return {'method': 'textDocument/didOpen',
+                'params': {'textDocument': {'uri': self.uri,
+                                            'languageId': 'asm',
+                                            'version': 1, 'text': text}}}
+
+    def position_message(self, id, method, line, character):
+        return {'id': id, 'method': method,
+                'params': {'textDocument': {'uri': self.uri},
+                           'position': {'line': line,
+                                        'character': character}}}
+
+    def change_message(self, start, end, text):
+        return {'method': 'textDocument/didChange',
+                'params': {'textDocument': {'uri': self.uri, 'version': 2},
+                           'contentChanges': [
+                               {'range': {'start': {'line': start[0],
+                                                    'character': start[1]},
+                                          'end': {'line': end[0],
+                                                  'character': end[1]}},
+                                'text': text}]}}
+
+    def test_initialize_and_exit(self):
+        code, sent = self.run_server(
+            {'id': 1, 'method': 'initialize', 'params': {}},
+            {'method': 'initialized', 'params': {}},
+            {'id': 2, 'method': 'shutdown'},
+            {'method': 'exit'})
+        self.assertEqual(code, 0)
+        capabilities = sent[0]['result']['capabilities']
+        self.assertEqual(capabilities['textDocumentSync'], 2)
+        self.assertTrue(capabilities['definitionProvider'])
+        self.assertTrue(capabilities['hoverProvider'])
+        self.assertEqual(sent[1], {'jsonrpc': '2.0', 'id': 2,
+                                   'result': None})
+        self.assertEqual(self.run_server({'method': 'exit'})[0], 1)
+
+    def test_unknown_request(self):
+        code, sent = self.run_server({'id': 1, 'method': 'nonsense'})
+        self.assertEqual(sent[0]['error']['code'], -32601)
+
+    def test_malformed_messages(self):
+        import contextlib
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr):
+            code, sent = self.run_server(
+                {'method': 'textDocument/didChange',
+                 'params': {'textDocument': {'uri': 'file:///none.asm'},
+                            'contentChanges': [{'text': 'STOP\n'}]}},
+                {'id': 1, 'method': 'textDocument/hover',
+                 'params': {'position': {'line': 0, 'character': 0}}},
+                b'Content-Length: 5\r\n\r\n{bad}',
+                b'Content-Length: 2\r\n\r\n[]',
+                b'Content-Length: x\r\n\r\n',
+                self.open_message(self.source),
+                self.position_message(2, 'textDocument/hover', 2, 7),
+                {'id': 3, 'method': 'shutdown'},
+                {'method': 'exit'})
+        self.assertEqual(code, 0)
+        self.assertIn('didChange', stderr.getvalue())
+        self.assertEqual(sent[0]['id'], 1)
+        self.assertEqual(sent[0]['error']['code'], -32602)
+        self.assertEqual([(message['id'], message['error']['code'])
+                          for message in sent[1:4]],
+                         [(None, -32700)] * 3)
+        self.assertEqual(sent[4]['result']['contents']['value'],
+                         'START at address $0010')
+        self.assertEqual(sent[5], {'jsonrpc': '2.0', 'id': 3,
+                                   'result': None})
+
+    def test_diagnostics_are_debounced(self):
+        code, sent = self.run_server(
+            self.open_message(self.source),
+            self.change_message((2, 2), (2, 5), 'BRX'),     # BRX START
+            self.change_message((1, 0), (1, 5), 'STAR'),    # START undefined
+            self.change_message((3, 9), (3, 9), 'Z'))       # $1234Z
+        self.assertEqual(len(sent), 1)
+        diagnostics = sent[0]['params']['diagnostics']
+        self.assertEqual([d['range']['start']['line'] for d in diagnostics],
+                         [1, 2, 3])
+        self.assertEqual(diagnostics[1]['range']['end']['character'], 11)
+        self.assertIn('BRX', diagnostics[1]['message'])
+
+    def test_edits_fix_errors(self):
+        code, sent = self.run_server(
+            self.open_message(self.source.replace('BRA', 'BRX')),
+            self.change_message((2, 2), (2, 5), 'BRA'),
+            self.change_message((3, 0), (4, 0), 'DATA .DW $1\n  .DW $2\n'))
+        self.assertEqual(sent[0]['params']['diagnostics'], [])
+
+    def test_definition_and_hover(self):
+        code, sent = self.run_server(
+            self.open_message(self.source + 'K .EQU $7\n'),
+            self.change_message((2, 0), (2, 0), '  LI R2, K\n'),
+            self.position_message(1, 'textDocument/definition', 1, 13),
+            self.position_message(2, 'textDocument/hover', 1, 14),
+            self.position_message(3, 'textDocument/hover', 2, 9),
+            self.position_message(4, 'textDocument/hover', 1, 7),
+            self.position_message(5, 'textDocument/definition', 5, 1))
+        responses = dict((m['id'], m.get('result')) for m in sent
+                         if 'id' in m)
+        self.assertEqual(responses[1]['range']['start']['line'], 4)
+        self.assertEqual(responses[2]['contents']['value'],
+                         'DATA at address $001C')
+        self.assertEqual(responses[2]['range']['start']['character'], 13)
+        self.assertEqual(responses[3]['contents']['value'], 'K .EQU $0007')
+        self.assertIsNone(responses[4])       # R1 isn't a label
+        self.assertEqual(responses[5]['range']['start']['line'], 5)
+
+    def test_edit_work(self):
+        """ An edit re-parses only its lines, and encodes again only the
+        lines whose words it changes (up to the next .ORG) """
+        text = ''.join('  .ORG ${:04X}\n'.format(block * 0x200) +
+                       ''.join('L{0} ADD R1, R2, R3\n  BRA L{0}\n'
+                               .format(block * 50 + i) for i in range(50))
+                       for block in range(50))
+        server = as240.LanguageServer(io.BytesIO(), io.BytesIO())
+        server.did_open(self.open_message(text)['params'])
+        engine = server.documents[self.uri]
+        engine.update()
+        calls = []
+        def counted(method):
+            def count(*args):
+                calls.append(method.__name__)
+                return method(*args)
+            return count
+        engine.parse = counted(engine.parse)
+        engine.encode = counted(engine.encode)
+        line = 10 * 101 + 11        # L505 ADD R1, R2, R3
+        self.assertEqual(engine.lines[line], 'L505 ADD R1, R2, R3\n')
+        server.did_change(self.change_message((line, 13), (line, 15),
+                                              'R4')['params'])
+        server.publish_pending()
+        engine.update()
+        # The line, and the line referring to its label (L505)
+        self.assertEqual(calls, ['parse', 'encode', 'encode'])
+        del calls[:]
+        server.did_change(self.change_message((line, 5), (line, 19),
+                                              'LI R1, $5')['params'])
+        server.publish_pending()
+        engine.update()
+        self.assertEqual(calls.count('parse'), 1)
+        # The lines moved: the rest of the block, to the next .ORG
+        self.assertEqual(calls.count('encode'), 11 * 101 + 1 - line)
+        program = as240.assemble(engine.source)
+        self.assertEqual(engine.image, dict(program.mem_locs))
+
+##### The memory image, and memory.hex made from it at once
+
+class TestMemoryImage(unittest.TestCase):
+
+    def legacy_mem_file(self, locs):
+        """ How create_mem_file used to write memory.hex: a line at a time """
+        mem_file = io.StringIO()
+        curr_addr = 0
+        for addr, val in sorted(locs, key=lambda x: x[0]):
+            while curr_addr < addr:
+                print("0000", file=mem_file)
+                curr_addr += 2
+            print('{:04X}'.format(val), file=mem_file)
+            curr_addr += 2
+        return mem_file.getvalue()
+
+    def test_same_as_legacy(self):
+        random.seed(21)
+        tests = [[], [(0xF000, 0x1234)], [(0x10, 7), (0x11, 5), (0x10, 3)],
+                 [(0xFFFE, 0x53), (0x10000, 0x10000)]]
+        for n in range(20):
+            tests.append([(random.randrange(0x200), random.randrange(0x10000))
+                          for i in range(random.randrange(1, 100))])
+        for locs in tests:
+            self.assertEqual(as240.MemoryImage(locs).hex_text(),
+                             self.legacy_mem_file(locs))
+
+    def test_words(self):
+        image = as240.MemoryImage([(4, 0xA), (0, 0xB)])
+        self.assertEqual(image.words, array.array('H', [0xB, 0, 0xA]))
+
+    def test_sparse(self):
+        image = as240.MemoryImage([(0xF000, 0x1234), (0xF010, 6),
+                                   (0xF002, 0)])
+        self.assertEqual(image.runs, [[0x7800, 0x7802], [0x7808, 0x7809]])
+        self.assertEqual(image.sparse_text(),
+                         '@7800\n1234\n0000\n@7808\n0006\n')
+        self.assertEqual(as240.MemoryImage([]).sparse_text(), '')
+
+    def test_sparse_loads_the_same_words(self):
+        random.seed(22)
+        for n in range(20):
+            locs = [(random.randrange(0x400), random.randrange(0x10000))
+                    for i in range(random.randrange(1, 50))]
+            dense = self.legacy_mem_file(locs).split()
+            loaded = {}
+            address = 0
+            for line in as240.MemoryImage(locs).sparse_text().split():
+                if line.startswith('@'):
+                    address = int(line[1:], 16)
+                else:
+                    loaded[address] = line
+                    address += 1
+            self.assertEqual(max(loaded) + 1, len(dense))
+            self.assertEqual(dict((address, word) for address, word
+                                  in enumerate(dense) if word != '0000'),
+                             dict((address, word) for address, word
+                                  in loaded.items() if word != '0000'))
+
+    def test_sparse_option(self):
+        options = as240.default_options()
+        options.sparse = True
+        program = as240.assemble('  .ORG $100\n  ADD R1, R2, R3\n', options)
+        mem = io.StringIO()
+        program.write_mem(mem)
+        self.assertEqual(mem.getvalue(), '@0080\n0053\n')
+        cache = as240.ResultCache('.', 0)
+        self.assertNotEqual(cache.key('', options),
+                            cache.key('', as240.default_options()))
+
+    def test_binary(self):
+        image = as240.MemoryImage([(0xF002, 0x1234), (0xF000, 0xABCD),
+                                   (0xF00A, 0x10005)])
+        data = image.binary()
+        self.assertEqual(len(data), 0x10000)
+        self.assertEqual(data[0xF000:0xF00C],
+                         bytes.fromhex('CDAB3412' + '00' * 6 + '0500'))
+        self.assertEqual(data.count(0), 0x10000 - 5)
+        data = image.binary(span=True)
+        self.assertEqual(data[:12], b'R240' + bytes.fromhex('00780000' +
+                                                            '06000000'))
+        self.assertEqual(data[12:], bytes.fromhex('CDAB3412' + '00' * 6 +
+                                                  '0500'))
+        self.assertEqual(as240.MemoryImage([]).binary(span=True),
+                         b'R240' + bytes(8))
+
+    def test_binary_option(self):
+        options = as240.default_options()
+        options.bin_file, options.bin_span = 'memory.bin', True
+        program = as240.assemble('  .ORG $100\n  ADD R1, R2, R3\n', options)
+        data = io.BytesIO()
+        program.write_bin(data)
+        self.assertEqual(data.getvalue(), b'R240' + bytes.fromhex(
+                                                '80000000' + '01000000' +
+                                                '5300'))
+        saved = as240.SavedProgram(as240.program_outputs(program))
+        self.assertTrue(saved.writes_bin)
+        saved_data = io.BytesIO()
+        saved.write_bin(saved_data)
+        self.assertEqual(saved_data.getvalue(), data.getvalue())
+        self.assertFalse(as240.assemble('').writes_bin)
+
+    def test_overlapping_orgs(self):
+        options = as240.default_options()
+        options.bin_file, options.ihex_file = 'memory.bin', 'memory.ihex'
+        program = as240.assemble('  .ORG $100\n  ADD R1, R2, R3\n' +
+                                 '  ADD R1, R2, R3\n  .ORG $100\n' +
+                                 '  .DW $1234\n  .ORG $103\n  .DW $ABCD\n' +
+                                 '  .ORG $104\n  .DW $5678\n', options)
+        data = io.BytesIO()
+        program.write_bin(data)
+        data = data.getvalue()
+        self.assertEqual(len(data), 0x10000)
+        self.assertEqual(data[0x100:0x106], bytes.fromhex('3412CDAB7856'))
+        self.assertEqual(data.count(0), 0x10000 - 6)
+        text = io.StringIO()
+        program.write_ihex(text)
+        content, records = self.read_intel_hex(text.getvalue())
+        self.assertEqual(content, dict((address, data[address])
+                                       for address in range(0x100, 0x106)))
+
+    def read_intel_hex(self, text):
+        """ The content of an Intel HEX file, as a dict of byte address ->
+        byte, checking the checksums, and the data records of it """
+        content = {}
+        data_records = []
+        upper = 0
+        lines = text.splitlines()
+        self.assertEqual(lines[-1], ':00000001FF')
+        for line in lines:
+            self.assertEqual(line[0], ':')
+            record = bytes.fromhex(line[1:])
+            self.assertEqual(sum(record) & 0xFF, 0)
+            self.assertEqual(record[0], len(record) - 5)
+            data = record[4:-1]
+            if record[3] == 4:
+                upper = int.from_bytes(data, 'big') << 16
+            elif record[3] == 0:
+                address = upper + int.from_bytes(record[1:3], 'big')
+                data_records.append(data)
+                for offset, byte in enumerate(data):
+                    content[address + offset] = byte
+        return content, data_records
+
+    def test_intel_hex(self):
+        image = as240.MemoryImage([(0x100, 0x0053)])
+        self.assertEqual(image.intel_hex(),
+                         ':020100005300AA\n:00000001FF\n')
+        self.assertEqual(as240.MemoryImage([]).intel_hex(), ':00000001FF\n')
+        # Gaps are skipped, runs packed in records as long as they can be,
+        # and split at $10000
+        locs = [(address, address) for address in range(0x200, 0x4B0, 2)]
+        locs += [(0x8000, 0x1234), (0xFFFE, 0xABCD), (0xFFFF, 0x10005)]
+        image = as240.MemoryImage(locs)
+        content, records = self.read_intel_hex(image.intel_hex())
+        self.assertEqual([len(data) for data in records],
+                         [254, 254, 180, 2, 2, 2])
+        self.assertIn(':020000040001F9\n', image.intel_hex())
+        data = image.binary()
+        self.assertEqual(content, dict((address, data[address])
+                                       for address in content))
+        self.assertEqual(len(content), 2 * len(locs))
+        self.assertEqual(content[0x10000], 0x05)
+
+    def test_intel_hex_random(self):
+        for trial in range(20):
+            locs = [(random.randrange(0x400), random.randrange(0x10000))
+                    for i in range(random.randrange(1, 50))]
+            image = as240.MemoryImage(locs, word_addresses=True)
+            content, records = self.read_intel_hex(image.intel_hex())
+            data = image.binary()
+            self.assertEqual(content, dict((address, data[address])
+                                           for address in content))
+            words = dict((addr >> 1, val) for addr, val in locs)
+            self.assertEqual(dict((address >> 1, data[address] |
+                                   data[address + 1] << 8)
+                                  for address in content
+                                  if address % 2 == 0), words)
+            self.assertEqual(sorted(content), [address
+                                               for start, end in image.runs
+                                               for address in
+                                               range(2 * start, 2 * end)])
+
+    def test_intel_hex_option(self):
+        options = as240.default_options()
+        options.ihex_file = 'memory.ihex'
+        program = as240.assemble('  .ORG $100\n  ADD R1, R2, R3\n', options)
+        text = io.StringIO()
+        program.write_ihex(text)
+        self.assertEqual(text.getvalue(), ':020100005300AA\n:00000001FF\n')
+        saved = as240.SavedProgram(as240.program_outputs(program))
+        self.assertTrue(saved.writes_ihex)
+        saved_text = io.StringIO()
+        saved.write_ihex(saved_text)
+        self.assertEqual(saved_text.getvalue(), text.getvalue())
+        self.assertFalse(as240.assemble('').writes_ihex)
+
+    def read_mif(self, text):
+        """ The content of a MIF file, as a dict of address -> data """
+        content = {}
+        body = text[text.index('BEGIN') + 5:text.index('END;')]
+        for record in body.split(';')[:-1]:
+            addresses, data = record.split(':')
+            if '..' in addresses:
+                first, last = addresses.strip(' \n[]').split('..')
+            else:
+                first = last = addresses
+            for address in range(int(first, 16), int(last, 16) + 1):
+                content[address] = int(data, 16)
+        return content
+
+    def test_mif_ranges(self):
+        self.assertEqual(as240.mif_ranges([(0x100, 0), (0x102, 0),
+                                           (0x104, 0x53), (0x106, 5),
+                                           (0x108, 5), (0x10A, 5)]),
+                         [[0, 0x102, 0], [0x104, 0x104, 0x53],
+                          [0x106, 0x10A, 5], [0x10B, 0xFFFF, 0]])
+        self.assertEqual(as240.mif_ranges([]), [[0, 0xFFFF, 0]])
+        mif = io.StringIO()
+        as240.create_mif_file(mif, [(2, 0xA), (4, 0xB)])
+        self.assertTrue(mif.getvalue().endswith(
+            'BEGIN\n             \n[0000 .. 0001] : 0000;\n0002 : 000A;\n' +
+            '0004 : 000B;\n[0005 .. FFFF] : 0000;\nEND;\n'))
+
+    def test_mif_content(self):
+        random.seed(23)
+        for n in range(20):
+            locs = [(random.randrange(0x300), random.choice((0, 5, 0x1234)))
+                    for i in range(random.randrange(1, 60))]
+            mif = io.StringIO()
+            as240.create_mif_file(mif, locs)
+            content = self.read_mif(mif.getvalue())
+            words = dict(locs)
+            self.assertEqual(content[0xFFFF], 0)
+            for address in range(0x400):
+                if address in words:
+                    self.assertEqual(content[address], words[address])
+                elif content.get(address, 0) != 0:   # inside a run
+                    self.assertEqual(words.get(address - 1),
+                                     content[address])
+                    self.assertEqual(words.get(address + 1),
+                                     content[address])
+                elif address not in content:        # a single address
+                    self.assertIn(address - 1, words)
+                    self.assertIn(address + 1, words)
+
+    def test_full_image(self):
+        locs = [(addr, addr ^ 0x5A5A) for addr in range(0, 0x10000, 2)]
+        image = as240.MemoryImage(locs)
+        self.assertEqual(image.words.typecode, 'H')
+        self.assertEqual(image.runs, [[0, 0x8000]])
+        writes = []
+        class MemFile(io.StringIO):
+            def write(self, text):
+                writes.append(len(text))
+                return io.StringIO.write(self, text)
+        mem_file = MemFile()
+        as240.create_mem_file(mem_file, locs)
+        self.assertEqual(writes, [5 * 0x8000])      # All at once
+        self.assertEqual(mem_file.getvalue(), self.legacy_mem_file(locs))
+
+##### Writing outputs only if they changed (--if-changed)
+
+class TestIfChanged(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = self.tmp.name
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name, text):
+        f = as240.AtomicOutputFile(os.path.join(self.dir, name))
+        print(text, file=f)
+        return f.close()
+
+    def test_atomic_output_file(self):
+        path = os.path.join(self.dir, 'out.txt')
+        self.assertTrue(self.write('out.txt', 'one'))
+        os.chmod(path, 0o640)
+        os.utime(path, (1000000, 1000000))
+        self.assertFalse(self.write('out.txt', 'one'))
+        self.assertEqual(os.stat(path).st_mtime, 1000000)
+        self.assertTrue(self.write('out.txt', 'two'))
+        with open(path) as f:
+            self.assertEqual(f.read(), 'two\n')
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o640)
+        f = as240.AtomicOutputFile(path)
+        print('never closed', file=f)
+        del f
+        self.assertEqual(os.listdir(self.dir), ['out.txt'])
+
+    def test_new_file_mode(self):
+        from unittest.mock import patch
+        umask = os.umask(0o027)
+        try:
+            with patch.object(os, 'umask',
+                              side_effect=AssertionError('umask changed')):
+                self.write('new.txt', 'one')
+        finally:
+            os.umask(umask)
+        self.assertEqual(os.stat(os.path.join(self.dir, 'new.txt')).st_mode
+                         & 0o777, 0o640)
+
+    def run_main(self, source):
+        from unittest.mock import patch
+        with open(os.path.join(self.dir, 'prog.asm'), 'w') as f:
+            f.write(source)
+        names = [os.path.join(self.dir, name)
+                 for name in ('prog.asm', 'prog.list', 'memory.hex',
+                              'memory.mif')]
+        argv = ['as240.py', '--if-changed', '-l', names[1], '-m', names[2],
+                '--miffilename', names[3], names[0]]
+        with patch(target='sys.argv', new=argv), \
+             patch(target='sys.stderr', new=io.StringIO()):
+            try:
+                as240.main()
+                code = 0
+            except SystemExit as e:
+                code = e.code
+        outputs = []
+        for name in names[1:]:
+            with open(name) as f:
+                outputs.append((f.read(), os.stat(name).st_mtime))
+            os.utime(name, (1000000, 1000000))
+        return code, outputs
+
+    def test_main(self):
+        code, outputs = self.run_main('  .ORG $0\n  ADD R1, R2, R3\n')
+        self.assertEqual(code, 0)
+        self.assertIn('0000 0053', outputs[0][0])
+        outputs = [(text, 1000000) for text, mtime in outputs]
+        self.assertEqual(self.run_main('  .ORG $0\n  ADD R1, R2, R3\n'),
+                         (0, outputs))
+        self.assertEqual(self.run_main('  .ORG $0\n  FOO R1\n'),
+                         (1, outputs))
+        self.assertEqual(sorted(os.listdir(self.dir)),
+                         ['memory.hex', 'memory.mif', 'prog.asm',
+                          'prog.list'])
+
+##### Startup time: importing as240 must stay fast
+
+class TestStartup(unittest.TestCase):
+
+    # Modules which only some modes need, so importing as240 mustn't
+    deferred = ('optparse', 'json', 'hashlib', 'tempfile', 'socket',
+                'socketserver', 'signal', 'queue', 'threading',
+                'multiprocessing', 'glob', 'random', 'numpy', 'base64')
+
+    def python(self, *args):
+        """ Run python with as240 importable (and its bytecode cached) """
+        import subprocess
+        env = dict(os.environ)
+        env.pop('PYTHONDONTWRITEBYTECODE', None)
+        env['PYTHONPATH'] = os.path.dirname(os.path.abspath(as240.__file__))
+        return subprocess.run((sys.executable, ) + args, env=env, check=True,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              universal_newlines=True)
+
+    def test_import_is_lazy(self):
+        result = self.python('-c', 'import sys, as240\n' +
+                             'print([m for m in ' + repr(self.deferred) +
+                             ' if m in sys.modules])\n' +
+                             "print(type(as240.AsmLine.__dict__" +
+                             "['re_statement']).__name__)")
+        self.assertEqual(result.stdout.split(), ['[]', 'lazy_regex'])
+
+    def test_launcher(self):
+        import tempfile
+        launcher = os.path.join(os.path.dirname(os.path.abspath(
+                                    as240.__file__)), 'as240')
+        with tempfile.TemporaryDirectory() as tmp:
+            asm_name = os.path.join(tmp, 'prog.asm')
+            with open(asm_name, 'w') as f:
+                f.write('  .ORG $10\n  STOP\n')
+            result = self.python('-X', 'importtime', launcher, asm_name, '-o')
+        # as240.py is imported (so its bytecode is cached), not run
+        self.assertIn('| as240\n', result.stderr)
+        self.assertIn('0010 FE00', result.stdout.upper())
+
 ##### Testing argument parsing in preparation for changing to argparse (12 Jun 2019, WAN)
 class TestCmdLineParsing(unittest.TestCase):
     